@@ -0,0 +1,338 @@
+import binascii
+import io
+import os
+import re
+import threading
+
+import numpy as np
+import torch
+from PIL import Image
+
+try:
+    from .tensor_pool import empty_tensor
+except ImportError:
+    from tensor_pool import empty_tensor
+
+# 每次解码的base64字符数，必须是4的倍数
+_CHUNK_SIZE = 1 << 20
+
+# 每个线程复用自己的解码缓冲区，避免每次调用都分配整幅图像大小的bytes
+_thread_local = threading.local()
+# 线程在两次解码之间保留的缓冲区上限（MB）；默认能容纳8-16 MP的PNG，更大的缓冲区
+# 用完即释放，否则批量解码线程池中的每个线程都会一直占用最大payload大小的内存
+RETAINED_BUFFER_MAX_BYTES = int(os.environ.get("BASE64_DECODE_BUFFER_MB", "64")) * 1024 * 1024
+
+# base64字母表以外的字符（与base64.b64decode一致，解码时忽略）
+_NON_ALPHABET = re.compile(r"[^A-Za-z0-9+/]")
+
+
+def _has_whitespace(chunk):
+    return " " in chunk or "\n" in chunk or "\r" in chunk or "\t" in chunk
+
+
+def strip_data_url_prefix(base64_string):
+    """移除data URL前缀（例如 "data:image/png;base64,"）"""
+    index = base64_string.find("base64,")
+    if index != -1:
+        return base64_string[index + len("base64,"):]
+    return base64_string
+
+
+def normalize_base64(base64_string):
+    """移除前缀和空白，得到用于比较内容的规范化payload；无空白时不复制字符串"""
+    base64_string = strip_data_url_prefix(base64_string)
+    if _has_whitespace(base64_string):
+        base64_string = "".join(base64_string.split())
+    return base64_string
+
+
+def _get_decode_buffer(size):
+    """获取当前线程的可复用解码缓冲区，容量不足时扩容"""
+    buffer = getattr(_thread_local, "buffer", None)
+    if buffer is None or len(buffer) < size:
+        buffer = bytearray(size)
+        _thread_local.buffer = buffer
+    return buffer
+
+
+def release_decode_buffer():
+    """解码结果不再引用缓冲区后调用：超过保留上限的线程缓冲区交还给内存分配器"""
+    buffer = getattr(_thread_local, "buffer", None)
+    if buffer is not None and len(buffer) > RETAINED_BUFFER_MAX_BYTES:
+        _thread_local.buffer = None
+
+
+def decode_base64_to_buffer(base64_string):
+    """分块解码base64字符串到线程本地缓冲区
+
+    只对包含空白的块做清理，不再对整个字符串跑正则。返回的memoryview
+    指向复用的缓冲区，在同一线程下一次解码之前有效。
+    """
+    buffer = _get_decode_buffer(len(base64_string) * 3 // 4 + 3)
+    view = memoryview(buffer)
+    try:
+        return _decode_chunks(base64_string, view)
+    except binascii.Error:
+        # 分块按原始长度对齐，字母表以外的字符（如多余的引号）会打乱对齐；
+        # 这种少见情况下过滤后整体解码
+        decoded = _NON_ALPHABET.sub("", base64_string.split("=", 1)[0])
+        decoded = binascii.a2b_base64(decoded + "=" * (-len(decoded) % 4))
+        view[:len(decoded)] = decoded
+        return view[:len(decoded)]
+
+
+def _decode_chunks(base64_string, view):
+    offset = 0
+    carry = ""
+
+    for start in range(0, len(base64_string), _CHUNK_SIZE):
+        chunk = base64_string[start:start + _CHUNK_SIZE]
+        if carry:
+            chunk = carry + chunk
+        if _has_whitespace(chunk):
+            chunk = "".join(chunk.split())
+
+        # 只解码完整的4字符组，剩余部分并入下一块
+        usable = len(chunk) - len(chunk) % 4
+        carry = chunk[usable:]
+        if usable:
+            decoded = binascii.a2b_base64(chunk[:usable] if carry else chunk)
+            view[offset:offset + len(decoded)] = decoded
+            offset += len(decoded)
+
+    if carry:
+        # 补齐缺失的填充字符
+        decoded = binascii.a2b_base64(carry + "=" * (-len(carry) % 4))
+        view[offset:offset + len(decoded)] = decoded
+        offset += len(decoded)
+
+    return view[:offset]
+
+
+class BufferReader(io.RawIOBase):
+    """只读、可寻址的memoryview文件对象，供PIL直接读取解码缓冲区"""
+
+    def __init__(self, view):
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._pos + offset
+        elif whence == io.SEEK_END:
+            position = len(self._view) + offset
+        else:
+            raise ValueError(f"无效的whence: {whence}")
+        if position < 0:
+            raise ValueError(f"无效的偏移: {position}")
+        self._pos = position
+        return position
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else min(self._pos + size, len(self._view))
+        if self._pos >= end:
+            return b""
+        data = self._view[self._pos:end].tobytes()
+        self._pos = end
+        return data
+
+    def readinto(self, target):
+        data = self.read(len(target))
+        target[:len(data)] = data
+        return len(data)
+
+
+# 常见图像格式的文件头（WEBP需额外检查偏移8处的标记，单独处理）
+_MAGIC_FORMATS = (
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+    (b"II*\x00", "TIFF"),
+    (b"MM\x00*", "TIFF"),
+    (b"BM", "BMP"),
+)
+
+
+def sniff_image_format(data):
+    """根据文件头识别图像格式，返回PIL格式名，无法识别时返回None"""
+    header = bytes(data[:12])
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "WEBP"
+    for magic, format_name in _MAGIC_FORMATS:
+        if header.startswith(magic):
+            return format_name
+    return None
+
+
+def open_image(view, require_known_format=False):
+    """从解码缓冲区打开并完整加载图像
+
+    先按文件头识别格式，只让PIL尝试对应的解码器。require_known_format为True时，
+    无法识别的数据直接报错，不再逐个尝试所有插件。
+    缓冲区会被后续解码复用，因此必须在返回前调用load()。
+    """
+    format_name = sniff_image_format(view)
+    if format_name is None and require_known_format:
+        raise ValueError(f"无法识别的图像格式，文件头: {bytes(view[:12]).hex()}")
+    image = Image.open(BufferReader(view), formats=[format_name] if format_name else None)
+    image.load()
+    return image
+
+
+def image_to_array(image):
+    """将PIL图像转换为 [H,W,3] 的uint8数组"""
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return np.asarray(image)
+
+
+# 加载节点可选的输出精度
+OUTPUT_DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+}
+
+# numpy不支持bfloat16，按行分块经float32中转时每块的行数
+_ROWS_PER_CHUNK = 256
+
+
+def normalize_into(array, out, invert=False):
+    """将uint8数组归一化到[0,1]（可选反转），原地写入形状相同的输出张量"""
+    if out.dtype in (torch.float32, torch.float16):
+        # numpy以float32计算并在写出时转换，不会产生整幅float32临时数组
+        target = out.numpy()
+        np.divide(array, 255.0, out=target, dtype=np.float32)
+        if invert:
+            np.subtract(1.0, target, out=target, dtype=np.float32)
+        return out
+
+    for start in range(0, array.shape[0], _ROWS_PER_CHUNK):
+        block = np.divide(array[start:start + _ROWS_PER_CHUNK], 255.0, dtype=np.float32)
+        if invert:
+            np.subtract(1.0, block, out=block)
+        out[start:start + _ROWS_PER_CHUNK].copy_(torch.from_numpy(block))
+    return out
+
+
+def composite_into(array, out):
+    """将 [H,W,4] 的RGBA uint8数组合成到白色背景上，直接写入 [H,W,3] 输出张量
+
+    按行分块计算 1 + (rgb/255 - 1) * alpha/255，临时数组只有一个块大小。
+    """
+    for start in range(0, array.shape[0], _ROWS_PER_CHUNK):
+        block = array[start:start + _ROWS_PER_CHUNK]
+        alpha = np.divide(block[..., 3:], 255.0, dtype=np.float32)
+        rgb = np.divide(block[..., :3], 255.0, dtype=np.float32)
+        rgb -= 1.0
+        rgb *= alpha
+        rgb += 1.0
+        out[start:start + _ROWS_PER_CHUNK].copy_(torch.from_numpy(rgb))
+    return out
+
+
+def array_to_tensor(array, out=None, dtype=torch.float32):
+    """将uint8数组归一化后直接写入输出张量，RGBA数组会合成到白色背景上
+
+    out为None时从缓冲池获取 [1,H,W,3] 张量；否则写入给定的 [H,W,3] 张量切片。
+    """
+    if out is None:
+        out = empty_tensor((1,) + array.shape[:2] + (3,), dtype=dtype)
+        target = out[0]
+    else:
+        target = out
+    if array.shape[-1] == 4:
+        composite_into(array, target)
+    else:
+        normalize_into(array, target)
+    return out
+
+
+def alpha_to_mask(array, dtype=torch.float32):
+    """取出RGBA数组的alpha通道作为 [1,H,W] 蒙版（1为不透明），无alpha时全为1"""
+    out = empty_tensor((1,) + array.shape[:2], dtype=dtype)
+    if array.shape[-1] == 4:
+        normalize_into(array[..., 3], out[0])
+    else:
+        out.fill_(1.0)
+    return out
+
+
+def image_to_tensor(image):
+    """将PIL图像转换为 [1,H,W,3] 的float32张量，归一化直接写入输出张量"""
+    return array_to_tensor(image_to_array(image))
+
+
+# URL安全base64字符到标准字符的映射
+_URLSAFE_TABLE = str.maketrans("-_", "+/")
+
+
+def decode_image(base64_string, require_known_format=False, urlsafe=False):
+    """base64字符串 -> 已加载的PIL图像（单次解码，按文件头分派解码器）"""
+    base64_string = strip_data_url_prefix(base64_string)
+    if urlsafe and ("-" in base64_string or "_" in base64_string):
+        base64_string = base64_string.translate(_URLSAFE_TABLE)
+    view = decode_base64_to_buffer(base64_string)
+    try:
+        return open_image(view, require_known_format)
+    finally:
+        view.release()
+        release_decode_buffer()
+
+
+def decode_image_array(base64_string):
+    """base64字符串 -> [H,W,3] uint8数组"""
+    return image_to_array(decode_image(base64_string))
+
+
+# 蒙版可选取的通道
+MASK_CHANNELS = ["luminance", "alpha", "red", "green", "blue"]
+_CHANNEL_BANDS = {"alpha": "A", "red": "R", "green": "G", "blue": "B"}
+
+
+def mask_channel_array(image, channel="luminance"):
+    """从图像中取出蒙版通道，返回 [H,W] uint8数组
+
+    单通道图像和已包含目标通道的图像直接取通道，不做整幅RGB->L转换。
+    """
+    if channel == "luminance":
+        if image.mode != "L":
+            image = image.convert("L")
+        return np.asarray(image)
+
+    band = _CHANNEL_BANDS[channel]
+    if image.mode == "P":
+        image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+
+    bands = image.getbands()
+    if band in bands:
+        return np.asarray(image.getchannel(band))
+    if band == "A":
+        # 没有alpha通道即完全不透明
+        return np.full((image.height, image.width), 255, dtype=np.uint8)
+    if "L" in bands:
+        # 灰度图像的R/G/B通道都等于亮度
+        return np.asarray(image.getchannel("L"))
+    return np.asarray(image.convert("RGB").getchannel(band))
+
+
+def decode_mask_array(base64_string, channel="luminance"):
+    """base64字符串 -> [H,W] uint8蒙版数组"""
+    return mask_channel_array(decode_image(base64_string), channel)
+
+
+def decode_image_tensor(base64_string):
+    """base64字符串 -> [1,H,W,3] float32图像张量"""
+    return array_to_tensor(decode_image_array(base64_string))
@@ -1,10 +1,50 @@
 import numpy as np
 import torch
-import base64
-import re
-from io import BytesIO
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 
+try:
+    from .base64_decode import OUTPUT_DTYPES, MASK_CHANNELS, decode_image_array, decode_mask_array, array_to_tensor, normalize_into
+except ImportError:
+    from base64_decode import OUTPUT_DTYPES, MASK_CHANNELS, decode_image_array, decode_mask_array, array_to_tensor, normalize_into
+
+try:
+    from .decode_cache import get_decode_cache
+except ImportError:
+    from decode_cache import get_decode_cache
+
+try:
+    from .tensor_pool import empty_tensor
+except ImportError:
+    from tensor_pool import empty_tensor
+
+# Shared decode pool for batch loading; PIL releases the GIL while decoding
+_decode_executor = None
+_decode_executor_lock = threading.Lock()
+
+def get_decode_executor():
+    global _decode_executor
+    with _decode_executor_lock:
+        if _decode_executor is None:
+            _decode_executor = ThreadPoolExecutor(
+                max_workers=min(8, os.cpu_count() or 1),
+                thread_name_prefix="Base64Decode",
+            )
+        return _decode_executor
+
+def parse_base64_list(base64_strings):
+    """Split a JSON array or newline-separated list into individual payloads"""
+    text = base64_strings.strip()
+    if text.startswith("["):
+        payloads = json.loads(text)
+        if not isinstance(payloads, list):
+            raise ValueError("JSON input must be an array of base64 strings")
+        return [str(payload) for payload in payloads if payload]
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
 class Base64ImageLoader:
     @classmethod
     def INPUT_TYPES(cls):
@@ -12,6 +52,9 @@ class Base64ImageLoader:
             "required": {
                 "base64_string": ("STRING", {"multiline": True, "default": ""}),
             },
+            "optional": {
+                "output_dtype": (list(OUTPUT_DTYPES), {"default": "float32"}),
+            },
         }
 
     RETURN_TYPES = ("IMAGE",)
@@ -19,31 +62,89 @@ class Base64ImageLoader:
     CATEGORY = "ETN"
     DISPLAY_NAME = "Base64 Image"
 
-    def load_image(self, base64_string):
-        # Remove data URL prefix if present (e.g. "data:image/png;base64,")
-        if "base64," in base64_string:
-            base64_string = base64_string.split("base64,")[1]
-        
-        # Remove any whitespace that may have been introduced in formatting
-        base64_string = re.sub(r'\s+', '', base64_string)
-        
-        # Decode the base64 string
+    def load_image(self, base64_string, output_dtype="float32"):
+        dtype = OUTPUT_DTYPES[output_dtype]
+        # Decode in chunks into a reused buffer; the data URL prefix and any
+        # whitespace introduced in formatting are handled by the decoder.
+        # The decode cache keeps the uint8 pixels, normalization to the
+        # requested dtype happens once, directly into the output tensor.
         try:
-            image_data = base64.b64decode(base64_string)
-            image = Image.open(BytesIO(image_data)).convert("RGB")
-            
-            # Convert to tensor format expected by ComfyUI
-            img_tensor = torch.from_numpy(np.array(image).astype(np.float32) / 255.0)
-            img_tensor = img_tensor.unsqueeze(0) # Add batch dimension
-            
+            image_array = get_decode_cache().get_or_decode("image", base64_string, decode_image_array)
+            img_tensor = array_to_tensor(image_array, dtype=dtype)
             return (img_tensor,)
         except Exception as e:
             print(f"Error loading base64 image: {e}")
             # Return a small placeholder red image in case of error
-            placeholder = torch.zeros((1, 64, 64, 3), dtype=torch.float32)
+            placeholder = torch.zeros((1, 64, 64, 3), dtype=dtype)
             placeholder[..., 0] = 1.0  # Red color for error
             return (placeholder,)
 
+class Base64ImageBatchLoader:
+    SIZE_POLICIES = ["pad", "resize", "error"]
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "base64_strings": ("STRING", {"multiline": True, "default": ""}),
+                "size_policy": (cls.SIZE_POLICIES, {"default": "pad"}),
+            },
+            "optional": {
+                "output_dtype": (list(OUTPUT_DTYPES), {"default": "float32"}),
+            },
+        }
+
+    RETURN_TYPES = ("IMAGE",)
+    FUNCTION = "load_images"
+    CATEGORY = "ETN"
+    DISPLAY_NAME = "Base64 Image Batch"
+
+    @staticmethod
+    def _decode_or_none(base64_string):
+        try:
+            return decode_image_array(base64_string)
+        except Exception as e:
+            print(f"Error loading base64 image in batch: {e}")
+            return None
+
+    def load_images(self, base64_strings, size_policy, output_dtype="float32"):
+        payloads = parse_base64_list(base64_strings)
+        if not payloads:
+            raise ValueError("No base64 images provided")
+
+        # Decode all frames in parallel; map() keeps the input order
+        arrays = list(get_decode_executor().map(self._decode_or_none, payloads))
+        decoded = [array for array in arrays if array is not None]
+        if not decoded:
+            raise ValueError("None of the base64 images could be decoded")
+
+        # "pad" grows the canvas to the largest frame, the others keep the first frame's size
+        if size_policy == "pad":
+            height = max(array.shape[0] for array in decoded)
+            width = max(array.shape[1] for array in decoded)
+        else:
+            height, width = decoded[0].shape[:2]
+
+        batch = empty_tensor((len(arrays), height, width, 3), dtype=OUTPUT_DTYPES[output_dtype]).zero_()
+        for i, array in enumerate(arrays):
+            if array is None:
+                batch[i, ..., 0] = 1.0  # Red placeholder for frames that failed to decode
+                continue
+
+            if array.shape[:2] != (height, width):
+                if size_policy == "error":
+                    raise ValueError(
+                        f"Image {i} has size {array.shape[1]}x{array.shape[0]}, "
+                        f"expected {width}x{height}"
+                    )
+                if size_policy == "resize":
+                    array = np.asarray(Image.fromarray(array).resize((width, height), Image.BILINEAR))
+
+            # Padded frames are written into the top-left corner of a black canvas
+            array_to_tensor(array, out=batch[i, :array.shape[0], :array.shape[1]])
+
+        return (batch,)
+
 class Base64MaskLoader:
     @classmethod
     def INPUT_TYPES(cls):
@@ -52,6 +153,10 @@ class Base64MaskLoader:
                 "base64_string": ("STRING", {"multiline": True, "default": ""}),
                 "invert": ("BOOLEAN", {"default": False}),
             },
+            "optional": {
+                "channel": (MASK_CHANNELS, {"default": "luminance"}),
+                "output_dtype": (list(OUTPUT_DTYPES), {"default": "float32"}),
+            },
         }
 
     RETURN_TYPES = ("MASK",)
@@ -59,40 +164,61 @@ class Base64MaskLoader:
     CATEGORY = "ETN"
     DISPLAY_NAME = "Base64 Mask"
 
-    def load_mask(self, base64_string, invert):
-        # Remove data URL prefix if present
-        if "base64," in base64_string:
-            base64_string = base64_string.split("base64,")[1]
-        
-        # Remove whitespace
-        base64_string = re.sub(r'\s+', '', base64_string)
-        
+    @staticmethod
+    def _load_mask_array(base64_string, channel):
+        # The cached channel pixels are shared by inverted and plain masks
+        return get_decode_cache().get_or_decode(
+            f"mask:{channel}", base64_string, lambda payload: decode_mask_array(payload, channel)
+        )
+
+    def load_mask(self, base64_string, invert, channel="luminance", output_dtype="float32"):
+        dtype = OUTPUT_DTYPES[output_dtype]
         try:
-            image_data = base64.b64decode(base64_string)
-            mask_image = Image.open(BytesIO(image_data)).convert("L")  # Convert to grayscale
+            # A JSON array of payloads produces an (N,H,W) mask batch
+            if base64_string.lstrip().startswith("["):
+                payloads = parse_base64_list(base64_string)
+                if not payloads:
+                    raise ValueError("No base64 masks provided")
+                mask_arrays = list(get_decode_executor().map(
+                    lambda payload: self._load_mask_array(payload, channel), payloads
+                ))
+                height, width = mask_arrays[0].shape
+                for i, mask_array in enumerate(mask_arrays):
+                    if mask_array.shape != (height, width):
+                        raise ValueError(
+                            f"Mask {i} has size {mask_array.shape[1]}x{mask_array.shape[0]}, "
+                            f"expected {width}x{height}"
+                        )
+                
+                # Normalize (and invert) in place into the output batch
+                mask_tensor = empty_tensor((len(mask_arrays), height, width), dtype=dtype)
+                for i, mask_array in enumerate(mask_arrays):
+                    normalize_into(mask_array, mask_tensor[i], invert=invert)
+                
+                return (mask_tensor,)
             
-            # Convert to tensor format expected for masks
-            mask_np = np.array(mask_image).astype(np.float32) / 255.0
+            mask_array = self._load_mask_array(base64_string, channel)
             
-            if invert:
-                mask_np = 1.0 - mask_np
-                
-            mask_tensor = torch.from_numpy(mask_np)
+            # Normalize (and invert) in place into the output tensor
+            mask_tensor = empty_tensor(mask_array.shape, dtype=dtype)
+            normalize_into(mask_array, mask_tensor, invert=invert)
             
             return (mask_tensor,)
         except Exception as e:
             print(f"Error loading base64 mask: {e}")
             # Return a placeholder mask in case of error
-            placeholder = torch.zeros((64, 64), dtype=torch.float32)
+            placeholder = torch.zeros((64, 64), dtype=dtype)
             return (placeholder,)
 
 # Register the nodes
 NODE_CLASS_MAPPINGS = {
     "Base64ImageLoader": Base64ImageLoader,
+    "Base64ImageBatchLoader": Base64ImageBatchLoader,
     "Base64MaskLoader": Base64MaskLoader,
 }
 
 NODE_DISPLAY_NAME_MAPPINGS = {
     "Base64ImageLoader": "Base64 Image",
+    "Base64ImageBatchLoader": "Base64 Image Batch",
     "Base64MaskLoader": "Base64 Mask",
 }
\ No newline at end of file
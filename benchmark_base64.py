@@ -0,0 +1,578 @@
+#!/usr/bin/env python3
+"""
+Base64节点性能基准脚本
+
+用法:
+    python benchmark_base64.py decode [--megapixels 8] [--repeat 5]
+    python benchmark_base64.py reexec [--megapixels 8] [--repeat 5]
+    python benchmark_base64.py pool [--megapixels 8] [--repeat 5]
+    python benchmark_base64.py sniff [--megapixels 0.25] [--repeat 5]
+    python benchmark_base64.py encode [--megapixels 8] [--batch 4] [--repeat 3]
+    python benchmark_base64.py websocket [--megapixels 0.25] [--batch 32] [--latency-ms 0]
+    python benchmark_base64.py leafer [--megapixels 0.25] [--repeat 5]
+
+decode: 每个变体在独立子进程中运行，以便分别统计峰值RSS。
+reexec: 模拟ComfyUI输出缓存（签名为输入值），比较相同字符串与格式不同的重复提交在有无解码缓存时的执行次数和延迟。
+pool: 解码缓存命中时，比较有无张量缓冲池时每次输出的分配开销（CPU）。
+sniff: Leafer图像加载，比较旧的逐级回退链与按文件头分派在有效/损坏数据上的延迟。
+encode: ImageWebSocketOutput批量编码，比较逐张转换+PNG默认压缩与整批转换+线程池编码（不同格式/压缩级别）。
+websocket: WebSocketImageSender，比较每张新建连接、持久连接池顺序发送与编码/发送流水线的吞吐（张/秒）。
+leafer: LeaferElementReceiver，按脚本化的选中序列多次运行工作流，比较固定输入、每次手动修改force_update
+        与IS_CHANGED三种方式的节点执行次数以及输出过期元素的次数。
+"""
+
+import argparse
+import base64
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def _peak_rss_mb():
+    # Linux下ru_maxrss单位为KB，macOS下为字节
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def make_png_base64(megapixels):
+    """生成一张带噪声的PNG并返回其base64字符串（噪声避免PNG压缩过度）"""
+    import numpy as np
+    from PIL import Image
+
+    side = int((megapixels * 1_000_000) ** 0.5)
+    rng = np.random.default_rng(0)
+    array = rng.integers(0, 256, size=(side, side, 3), dtype=np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(array).save(buffer, format="PNG", compress_level=1)
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def legacy_load_image(base64_string):
+    """优化前的Base64ImageLoader.load_image实现，作为对照"""
+    import numpy as np
+    import torch
+    from PIL import Image
+
+    if "base64," in base64_string:
+        base64_string = base64_string.split("base64,")[1]
+    base64_string = re.sub(r'\s+', '', base64_string)
+    image_data = base64.b64decode(base64_string)
+    image = Image.open(BytesIO(image_data)).convert("RGB")
+    img_tensor = torch.from_numpy(np.array(image).astype(np.float32) / 255.0)
+    return img_tensor.unsqueeze(0)
+
+
+def streaming_load_image(base64_string):
+    from base64_nodes import Base64ImageLoader
+    return Base64ImageLoader().load_image(base64_string)[0]
+
+
+DECODE_VARIANTS = {
+    "legacy": legacy_load_image,
+    "streaming": streaming_load_image,
+}
+
+
+def run_decode_variant(variant, megapixels, repeat):
+    import torch  # noqa: F401  预先导入，避免把库加载计入峰值
+
+    payload = make_png_base64(megapixels)
+    loader = DECODE_VARIANTS[variant]
+    baseline = _peak_rss_mb()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        tensor = loader(payload)
+        timings.append(time.perf_counter() - start)
+        del tensor
+
+    return {
+        "variant": variant,
+        "megapixels": megapixels,
+        "best_ms": min(timings) * 1000,
+        "mean_ms": sum(timings) / len(timings) * 1000,
+        "peak_rss_delta_mb": _peak_rss_mb() - baseline,
+    }
+
+
+def bench_decode(args):
+    print(f"解码基准: {args.megapixels} MP PNG, 重复 {args.repeat} 次")
+    for variant in DECODE_VARIANTS:
+        output = subprocess.check_output([
+            sys.executable, os.path.abspath(__file__), "_decode_child",
+            "--variant", variant,
+            "--megapixels", str(args.megapixels),
+            "--repeat", str(args.repeat),
+        ])
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        print(f"  {result['variant']:>10}: best {result['best_ms']:8.1f} ms, "
+              f"mean {result['mean_ms']:8.1f} ms, "
+              f"peak RSS +{result['peak_rss_delta_mb']:7.1f} MB")
+
+
+class ExecutorCacheModel:
+    """简化的ComfyUI输出缓存：节点签名与上次相同时直接复用输出
+
+    与ComfyUI一致，签名为原始输入值（base64加载节点没有IS_CHANGED）。
+    """
+
+    def __init__(self):
+        self.signature = None
+        self.output = None
+        self.executions = 0
+
+    def run(self, node, base64_string):
+        signature = (base64_string,)
+        if signature != self.signature:
+            self.output = node.load_image(base64_string)
+            self.signature = signature
+            self.executions += 1
+        return self.output
+
+
+def bench_reexec(args):
+    from base64_nodes import Base64ImageLoader
+    from decode_cache import get_decode_cache
+
+    cache = get_decode_cache()
+    max_bytes = cache.max_bytes
+
+    payload = make_png_base64(args.megapixels)
+    wrapped = "\n".join(payload[i:i + 76] for i in range(0, len(payload), 76))
+    variants = {
+        # 完全相同的字符串重复提交
+        "相同字符串": [payload] * 3,
+        # 同一张图像以不同格式重复提交（原始、data URL、按76列换行）
+        "格式不同": [payload, "data:image/png;base64," + payload, wrapped],
+    }
+
+    print(f"重复提交基准: {args.megapixels} MP PNG, 每组 {3 * args.repeat} 次提交")
+    for sequence_name, variant in variants.items():
+        for use_cache in (False, True):
+            # 每次排队时ComfyUI都会重新解析prompt得到新的字符串对象，这里同样每次复制一份
+            prompts = [text[:1] + text[1:] for text in variant * args.repeat]
+            cache.clear()
+            cache.max_bytes = max_bytes if use_cache else 0
+            model = ExecutorCacheModel()
+            node = Base64ImageLoader()
+            timings = []
+            for prompt in prompts:
+                start = time.perf_counter()
+                model.run(node, prompt)
+                timings.append(time.perf_counter() - start)
+            label = "解码缓存" if use_cache else "无缓存"
+            print(f"  {sequence_name} {label:>8}: 执行 {model.executions:3d} 次, "
+                  f"首次 {timings[0] * 1000:8.1f} ms, "
+                  f"后续平均 {sum(timings[1:]) / max(len(timings) - 1, 1) * 1000:8.1f} ms")
+    cache.max_bytes = max_bytes
+
+
+def bench_pool(args):
+    from base64_nodes import Base64ImageLoader
+    from tensor_pool import get_tensor_pool
+
+    payload = make_png_base64(args.megapixels)
+    node = Base64ImageLoader()
+    # 预热解码缓存，之后每次调用只剩输出张量的分配与归一化
+    node.load_image(payload)
+
+    pool = get_tensor_pool()
+    # 只有CPU的主机上缓冲池默认禁用，基准中按512 MB上限启用
+    max_bytes = pool.max_bytes or 512 * 1024 * 1024
+    iterations = args.repeat * 10
+    print(f"缓冲池基准: {args.megapixels} MP PNG, {iterations} 次调用")
+    for enabled in (False, True):
+        pool.clear()
+        pool.max_bytes = max_bytes if enabled else 0
+        start = time.perf_counter()
+        for _ in range(iterations):
+            tensor = node.load_image(payload)[0]
+            del tensor
+        elapsed = (time.perf_counter() - start) / iterations
+        label = "缓冲池" if enabled else "torch.empty"
+        print(f"  {label:>11}: 平均 {elapsed * 1000:8.1f} ms/次, 统计 {pool.stats()}")
+
+
+def legacy_leafer_load(image_data):
+    """优化前LeaferElementReceiver的解码与逐级回退加载（去掉日志输出）"""
+    from PIL import Image
+
+    base64_data = image_data
+    if "base64," in image_data:
+        base64_data = image_data.split("base64,", 1)[1]
+    base64_data = base64_data.strip().replace('\n', '').replace('\r', '').replace(' ', '')
+    base64_data += '=' * (-len(base64_data) % 4)
+    if not re.match(r'^[A-Za-z0-9+/]*={0,2}$', base64_data):
+        base64_data = base64_data.replace('-', '+').replace('_', '/')
+        if not re.match(r'^[A-Za-z0-9+/]*={0,2}$', base64_data):
+            raise ValueError("包含无效的Base64字符")
+    try:
+        image_bytes = base64.b64decode(base64_data, validate=True)
+    except Exception:
+        image_bytes = base64.b64decode(base64_data, validate=False)
+
+    errors = []
+    for attempt in range(4):
+        # 直接加载、文件头检查、强制PNG、强制JPEG，各自重新包装字节
+        try:
+            image = Image.open(BytesIO(image_bytes))
+            if attempt >= 2:
+                image.load()
+            break
+        except Exception as e:
+            errors.append(e)
+    else:
+        raise ValueError(f"所有图像加载方法都失败: {errors}")
+    return image.convert("RGB")
+
+
+def sniff_leafer_load(image_data):
+    from base64_decode import decode_image
+    return decode_image(image_data, require_known_format=True, urlsafe=True).convert("RGB")
+
+
+def bench_sniff(args):
+    import numpy as np
+
+    valid = make_png_base64(args.megapixels)
+    raw = base64.b64decode(valid)
+    rng = np.random.default_rng(1)
+    fixtures = {
+        "有效PNG": "data:image/png;base64," + valid,
+        "截断PNG": base64.b64encode(raw[:len(raw) // 2]).decode("ascii"),
+        "未知格式": base64.b64encode(rng.bytes(len(raw))).decode("ascii"),
+        "非法字符": "data:image/png;base64," + valid[:len(valid) // 2] + "%%%" + valid[len(valid) // 2:],
+    }
+    iterations = args.repeat * 4
+
+    # 预热，避免把模块导入计入第一项
+    for loader in (legacy_leafer_load, sniff_leafer_load):
+        loader(fixtures["有效PNG"])
+
+    print(f"格式分派基准: {args.megapixels} MP PNG, 每项 {iterations} 次")
+    for name, payload in fixtures.items():
+        results = []
+        for loader in (legacy_leafer_load, sniff_leafer_load):
+            start = time.perf_counter()
+            for _ in range(iterations):
+                try:
+                    loader(payload)
+                except Exception:
+                    pass
+            results.append((time.perf_counter() - start) / iterations * 1000)
+        print(f"  {name}: 回退链 {results[0]:8.2f} ms, 文件头分派 {results[1]:8.2f} ms")
+
+
+def legacy_encode_batch(images):
+    """优化前ImageWebSocketOutput逐张转换为PNG字节的实现（去掉日志输出）"""
+    import numpy as np
+    from PIL import Image
+
+    encoded = []
+    for tensor in images:
+        if tensor.max() > 1.0:
+            tensor = tensor / 255.0
+        numpy_image = (tensor.squeeze().cpu().numpy() * 255).astype(np.uint8)
+        buffer = BytesIO()
+        Image.fromarray(numpy_image).save(buffer, format='PNG')
+        encoded.append(buffer.getvalue())
+    return encoded
+
+
+def bench_encode(args):
+    import torch
+    from image_websocket_node import ImageWebSocketOutput
+
+    side = int((args.megapixels * 1_000_000) ** 0.5)
+    # 平滑渐变加少量噪声，压缩特性接近真实生成图像
+    gradient = torch.linspace(0, 1, side).view(1, side, 1, 1)
+    images = (gradient + torch.rand(args.batch, side, side, 3) * 0.05).clamp_(0, 1)
+    node = ImageWebSocketOutput()
+
+    variants = [("逐张 PNG(6)", lambda: legacy_encode_batch(images))]
+    for image_format, level in (("png", 6), ("png", 1), ("webp", 6), ("jpeg", 6)):
+        label = f"并行 {image_format.upper()}" + (f"({level})" if image_format == "png" else "")
+        variants.append((label, lambda f=image_format, l=level: node.encode_images(images, f, l, 90)))
+
+    print(f"批量编码基准: {args.batch} x {args.megapixels} MP, 线程数 {os.cpu_count()}, 重复 {args.repeat} 次")
+    for label, run in variants:
+        run()
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            result = run()
+            timings.append(time.perf_counter() - start)
+        encoded = result if isinstance(result, list) else [data for _, data in result[0]]
+        size_mb = sum(len(data) for data in encoded) / (1024 * 1024)
+        print(f"  {label:>12}: best {min(timings) * 1000:8.1f} ms, 总大小 {size_mb:7.2f} MB")
+
+
+def start_websocket_sink(latency_ms=0):
+    """在后台线程启动一个只接收消息的本地WebSocket服务器，返回 (URL, 已接收计数)
+
+    latency_ms模拟慢速链路/接收端：每条消息处理后暂停，TCP缓冲区填满后发送端随之阻塞。
+    """
+    import asyncio
+    import threading
+    import websockets
+
+    received = [0]
+    ready = threading.Event()
+    address = {}
+
+    async def handler(websocket):
+        async for _ in websocket:
+            received[0] += 1
+            if latency_ms:
+                await asyncio.sleep(latency_ms / 1000)
+
+    async def serve():
+        server = await websockets.serve(handler, "127.0.0.1", 0, max_size=None)
+        address["port"] = server.sockets[0].getsockname()[1]
+        ready.set()
+        await server.serve_forever()
+
+    threading.Thread(target=lambda: asyncio.run(serve()), daemon=True).start()
+    ready.wait()
+    return f"ws://127.0.0.1:{address['port']}/image-ws", received
+
+
+def legacy_websocket_send(websocket_url, message):
+    """优化前WebSocketImageSender._send_websocket_sync：每条消息新建线程、事件循环和连接"""
+    import asyncio
+    import threading
+    import websockets
+
+    async def send():
+        async with websockets.connect(websocket_url, open_timeout=10, close_timeout=5,
+                                      ping_interval=20, ping_timeout=10, max_size=None) as websocket:
+            await websocket.send(message)
+
+    thread = threading.Thread(target=lambda: asyncio.run(send()))
+    thread.start()
+    thread.join()
+
+
+def bench_websocket(args):
+    import contextlib
+    import torch
+    from websocket_image_sender import WebSocketImageSender, get_websocket_pool
+
+    side = int((args.megapixels * 1_000_000) ** 0.5)
+    images = torch.rand(args.batch, side, side, 3)
+    websocket_url, received = start_websocket_sink(args.latency_ms)
+    node = WebSocketImageSender()
+
+    def encode_all():
+        return [node.encode_image_message(image, i, len(images), "benchmark", {}) for i, image in enumerate(images)]
+
+    def sequential(send):
+        # 优化前的顺序：编码第i张、发送并等待完成后才处理第i+1张
+        for i, image in enumerate(images):
+            send(websocket_url, node.encode_image_message(image, i, len(images), "benchmark", {}))
+
+    messages = encode_all()
+    variants = [
+        ("仅编码", encode_all),
+        ("仅发送", lambda: [node._send_websocket_sync(websocket_url, message) for message in messages]),
+        ("每张新建连接", lambda: sequential(legacy_websocket_send)),
+        ("连接池+顺序", lambda: sequential(node._send_websocket_sync)),
+        ("连接池+流水线", lambda: node.send_images_websocket(images, websocket_url=websocket_url)),
+    ]
+
+    print(f"WebSocket发送基准: {args.batch} x {args.megapixels} MP, 接收端延迟 {args.latency_ms} ms/条")
+    for label, run in variants:
+        before = received[0]
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            run()
+        elapsed = time.perf_counter() - start
+        print(f"  {label:>8}: {elapsed * 1000:8.1f} ms, {args.batch / elapsed:8.1f} 张/秒, "
+              f"服务器收到 {received[0] - before} 条")
+    print(f"  连接统计: {get_websocket_pool().stats()}")
+
+
+# 脚本化的选中序列：("select", 元素名) 模拟用户在画布中选中元素（可能重复选中同一元素），
+# ("unselect",) 取消选中，("run",) 运行一次工作流
+LEAFER_SCRIPT = [
+    ("select", "A"), ("run",), ("run",),
+    ("select", "A"), ("run",),
+    ("select", "B"), ("run",), ("run",),
+    ("unselect",), ("run",), ("run",),
+    ("select", "B"), ("select", "C"), ("run",), ("run",),
+    ("select", "C"), ("run",),
+]
+
+
+def start_leafer_server(payloads):
+    """在后台线程启动一个模拟Leafer画布的WebSocket服务器，返回 (URL, select函数)
+
+    select(name) 向已连接的客户端推送element_selected（name为None时推送element_unselected），
+    并把该元素作为 request_current_element 的响应内容。
+    """
+    import asyncio
+    import threading
+    import websockets
+
+    state = {"current": None, "clients": set()}
+    ready = threading.Event()
+    address = {}
+
+    def element_message(message_type):
+        name = state["current"]
+        if name is None:
+            return json.dumps({"type": "element_unselected"})
+        return json.dumps({"type": message_type, "elementName": name, "image": payloads[name]})
+
+    async def handler(websocket):
+        state["clients"].add(websocket)
+        try:
+            async for message in websocket:
+                if json.loads(message).get("type") == "request_current_element":
+                    await websocket.send(element_message("current_element_response"))
+        finally:
+            state["clients"].discard(websocket)
+
+    async def push(name):
+        state["current"] = name
+        for websocket in list(state["clients"]):
+            await websocket.send(element_message("element_selected"))
+
+    async def serve():
+        server = await websockets.serve(handler, "127.0.0.1", 0, max_size=None)
+        address["loop"] = asyncio.get_running_loop()
+        address["port"] = server.sockets[0].getsockname()[1]
+        ready.set()
+        await server.serve_forever()
+
+    threading.Thread(target=lambda: asyncio.run(serve()), daemon=True).start()
+    ready.wait()
+
+    def select(name):
+        asyncio.run_coroutine_threadsafe(push(name), address["loop"]).result()
+
+    return f"ws://127.0.0.1:{address['port']}", select
+
+
+class ReceiverExecutorModel:
+    """简化的ComfyUI执行器：节点签名（输入 + IS_CHANGED返回值）与上次相同时复用输出"""
+
+    def __init__(self, strategy):
+        self.strategy = strategy
+        self.signature = None
+        self.output = None
+        self.executions = 0
+        self.exec_time = 0.0
+
+    def run(self, node, server_url, run_index):
+        # "manual": 用户每次运行前都修改force_update，相当于每次输入都不同
+        force_update = run_index if self.strategy == "manual" else 0
+        inputs = dict(server_url=server_url, refresh=False, output_base64=False,
+                      force_update=force_update, unique_id="1")
+        signature = tuple(sorted(inputs.items()))
+        if self.strategy == "is_changed":
+            signature += (node.IS_CHANGED(**inputs),)
+        if signature != self.signature:
+            start = time.perf_counter()
+            self.output = node.receive_element(**inputs)
+            self.exec_time += time.perf_counter() - start
+            self.signature = signature
+            self.executions += 1
+        return self.output
+
+
+def bench_leafer(args):
+    import contextlib
+    from leafer_receiver_node import LeaferElementReceiver, get_leafer_pool
+
+    payloads = {name: make_png_base64(args.megapixels) for name in ("A", "B", "C")}
+    server_url, select = start_leafer_server(payloads)
+    node = LeaferElementReceiver()
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        connection = get_leafer_pool().acquire(server_url, "1")
+        # 等待连接建立；之后每次选中都用一次请求/响应往返确认客户端已处理完推送的消息
+        connection.call_in_loop(connection.request_current_element(10), 11)
+
+    script = LEAFER_SCRIPT * args.repeat
+    runs = sum(1 for event in script if event[0] == "run")
+    print(f"Leafer重新执行基准: {args.megapixels} MP PNG, {len(script) - runs} 次选中事件, {runs} 次运行")
+    for strategy, label in (("fixed", "固定输入"), ("manual", "手动force_update"), ("is_changed", "IS_CHANGED")):
+        model = ReceiverExecutorModel(strategy)
+        stale = 0
+        needed = 0
+        last_seen = None
+        run_index = 0
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            select(None)
+            connection.call_in_loop(connection.request_current_element(10), 11)
+            for event in script:
+                if event[0] == "select":
+                    select(event[1])
+                elif event[0] == "unselect":
+                    select(None)
+                else:
+                    connection.call_in_loop(connection.request_current_element(10), 11)
+                    run_index += 1
+                    current = connection.snapshot
+                    output = model.run(node, server_url, run_index)
+                    key = (current.element_name, current.payload_hash)
+                    if key != last_seen:
+                        needed += 1
+                        last_seen = key
+                    if output[1] != current.element_name:
+                        stale += 1
+        print(f"  {label:>16}: 执行 {model.executions:3d} 次 (元素实际变化 {needed} 次), "
+              f"输出过期元素 {stale:3d} 次, 节点执行耗时 {model.exec_time * 1000:8.1f} ms")
+
+
+# 各基准的默认参数，与模块文档中的用法一致；未列出的基准使用 --megapixels 8 --repeat 5
+BENCHMARK_DEFAULTS = {
+    "sniff": {"megapixels": 0.25},
+    "encode": {"batch": 4, "repeat": 3},
+    "websocket": {"megapixels": 0.25, "batch": 32},
+    "leafer": {"megapixels": 0.25},
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Base64节点性能基准")
+    parser.add_argument("benchmark", choices=["decode", "reexec", "pool", "sniff", "encode", "websocket", "leafer", "_decode_child"])
+    parser.add_argument("--variant", choices=list(DECODE_VARIANTS), default="streaming")
+    parser.add_argument("--megapixels", type=float, default=None)
+    parser.add_argument("--repeat", type=int, default=None)
+    parser.add_argument("--batch", type=int, default=None)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    args = parser.parse_args()
+    defaults = {"megapixels": 8, "repeat": 5, "batch": 4, **BENCHMARK_DEFAULTS.get(args.benchmark, {})}
+    for name, value in defaults.items():
+        if getattr(args, name) is None:
+            setattr(args, name, value)
+
+    if args.benchmark == "_decode_child":
+        print(json.dumps(run_decode_variant(args.variant, args.megapixels, args.repeat)))
+    elif args.benchmark == "decode":
+        bench_decode(args)
+    elif args.benchmark == "reexec":
+        bench_reexec(args)
+    elif args.benchmark == "pool":
+        bench_pool(args)
+    elif args.benchmark == "sniff":
+        bench_sniff(args)
+    elif args.benchmark == "encode":
+        bench_encode(args)
+    elif args.benchmark == "websocket":
+        bench_websocket(args)
+    elif args.benchmark == "leafer":
+        bench_leafer(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    from .base64_decode import normalize_base64
+except ImportError:
+    from base64_decode import normalize_base64
+
+# 默认缓存上限（MB），可通过环境变量调整，设为0则禁用缓存
+DEFAULT_MAX_MB = int(os.environ.get("BASE64_DECODE_CACHE_MB", "1024"))
+
+
+def payload_digest(payload):
+    """计算base64原始字符串的快速内容哈希（优先xxhash，否则blake2b）"""
+    data = payload.encode("utf-8") if isinstance(payload, str) else payload
+    if xxhash is not None:
+        return xxhash.xxh3_128_hexdigest(data)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def payload_fingerprint(payload):
+    """规范化payload（去掉data URL前缀和空白）后的内容指纹
+
+    同一张图片无论是否带前缀、如何换行，都得到相同的指纹，因此格式不同的
+    重复提交也能命中解码缓存。
+    原始图像字节（如二进制WebSocket帧）无需规范化，直接计算哈希。
+    """
+    if isinstance(payload, (bytes, bytearray, memoryview)):
+        return payload_digest(payload)
+    return payload_digest(normalize_base64(payload))
+
+
+def _nbytes(value):
+    """缓存条目可以是torch张量或numpy数组，两者都提供nbytes"""
+    return value.nbytes
+
+
+class DecodeCache:
+    """进程级LRU解码缓存，按已解码结果的总字节数限制容量
+
+    Base64加载节点缓存的是未归一化的uint8数组（延迟归一化），只在节点输出时
+    按所需精度转换，缓存占用约为float32的四分之一，且不同精度共用同一条目。
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= _nbytes(previous)
+            self._entries[key] = value
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= _nbytes(evicted)
+                self.evictions += 1
+
+    def get_or_decode(self, kind, payload, decode_fn):
+        """按 (kind, 内容指纹) 查找缓存，未命中时调用decode_fn(payload)并写入缓存
+
+        kind用于区分同一payload的不同解码结果（如图像、蒙版）。
+        decode_fn抛出的异常会直接传递给调用方，失败结果不会被缓存。
+        """
+        if self.max_bytes <= 0:
+            return decode_fn(payload)
+        key = (kind, payload_fingerprint(payload))
+        value = self.get(key)
+        if value is None:
+            value = decode_fn(payload)
+            if value is not None:
+                self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+_decode_cache = DecodeCache(DEFAULT_MAX_MB * 1024 * 1024)
+
+
+def get_decode_cache():
+    """获取进程级共享的解码缓存"""
+    return _decode_cache
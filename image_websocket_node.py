@@ -1,17 +1,650 @@
 import torch
-import numpy as np
+import aiohttp
+import asyncio
 import base64
+import concurrent.futures
 import json
-import requests
+import os
+import queue
+import shutil
+import stat
 import time
+import atexit
+import sys
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from PIL import Image
 from typing import Optional, Dict, Any
 import threading
 
+try:
+    from .decode_cache import payload_digest
+except ImportError:
+    from decode_cache import payload_digest
+
+try:
+    from .io_runtime import get_io_runtime
+except ImportError:
+    from io_runtime import get_io_runtime
+
+try:
+    import folder_paths
+except ImportError:
+    # 不在ComfyUI中运行（如基准脚本）
+    folder_paths = None
+
 # 全局变量用于存储当前执行的工作流
 _current_workflow_data = threading.local()
 
+# 代理返回这些状态码时视为不支持对应的格式或接口（multipart、批量消息、工作流引用）；
+# 400等其他错误表示消息本身有问题，按发送失败处理，不降级
+_UNSUPPORTED_TRANSPORT_STATUS = (404, 405, 415)
+
+# 降级记录的有效期（秒），到期后重新尝试（代理可能已经升级或重启）
+CAPABILITY_RETRY_SECONDS = float(os.environ.get("IMAGE_WS_CAPABILITY_RETRY", "600"))
+
+class ProxyCapabilities:
+    """记录各代理不支持的功能："multipart"、"batch"、"workflow_ref"
+
+    标记在CAPABILITY_RETRY_SECONDS秒后过期，之后重新尝试该功能。
+    """
+    
+    def __init__(self, retry_seconds):
+        self.retry_seconds = retry_seconds
+        self._unsupported = {}
+        self._lock = threading.Lock()
+    
+    def supports(self, proxy_url, capability):
+        key = (proxy_url, capability)
+        with self._lock:
+            expires = self._unsupported.get(key)
+            if expires is None:
+                return True
+            if time.monotonic() >= expires:
+                del self._unsupported[key]
+                return True
+            return False
+    
+    def mark_unsupported(self, proxy_url, capability):
+        with self._lock:
+            self._unsupported[(proxy_url, capability)] = time.monotonic() + self.retry_seconds
+
+_proxy_capabilities = ProxyCapabilities(CAPABILITY_RETRY_SECONDS)
+
+def is_unsupported_response(response, capability, statuses=_UNSUPPORTED_TRANSPORT_STATUS):
+    """响应是否表示代理不支持capability：状态码在statuses中，或错误响应体为 {"unsupported": capability}"""
+    if response.status_code in statuses:
+        return True
+    if response.status_code < 400:
+        return False
+    try:
+        body = response.json()
+    except ValueError:
+        return False
+    return isinstance(body, dict) and body.get("unsupported") == capability
+
+# 单个批量请求的图像数据上限（MB），超过时自动拆分为多个分块请求
+BATCH_MAX_BYTES = int(os.environ.get("IMAGE_WS_BATCH_MAX_MB", "32")) * 1024 * 1024
+
+# 每个代理地址保持的最大连接数（超过时请求等待空闲连接，而不是新建连接）
+HTTP_POOL_MAXSIZE = 4
+
+# 发送HTTP请求时可能出现的网络错误（连接失败、超时等）
+HTTP_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, concurrent.futures.TimeoutError)
+
+class HTTPResponse:
+    """已读取完毕的HTTP响应，提供status_code和json()"""
+    
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+    
+    def json(self):
+        return json.loads(self.content)
+
+class PooledHTTPSession:
+    """一个代理地址对应的持久HTTP会话：keep-alive连接池并统计复用率和延迟
+    
+    aiohttp会话由包内共享的I/O事件循环持有，post()可在任意线程中同步调用。
+    """
+    
+    def __init__(self, proxy_url):
+        self.proxy_url = proxy_url
+        self.session = None
+        self.connections = 0
+        self.request_count = 0
+        self.total_latency = 0.0
+        self._lock = threading.Lock()
+    
+    async def _on_connection_created(self, session, context, params):
+        self.connections += 1
+    
+    def _get_session(self):
+        # 只在I/O事件循环中调用
+        if self.session is None or self.session.closed:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_connection_create_end.append(self._on_connection_created)
+            # limit限制到该代理的并发连接数（超过时请求等待空闲连接，而不是新建连接）
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=HTTP_POOL_MAXSIZE),
+                trace_configs=[trace_config],
+            )
+        return self.session
+    
+    async def _post(self, url, json=None, files=None, headers=None, timeout=30):
+        data = None
+        if files is not None:
+            # 与requests相同的files格式: {字段名: (文件名, 内容, 内容类型)} 或其列表形式
+            data = aiohttp.FormData()
+            for name, (filename, content, content_type) in (files.items() if isinstance(files, dict) else files):
+                data.add_field(name, content, filename=filename, content_type=content_type)
+        async with self._get_session().post(
+            url, json=json, data=data, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)
+        ) as response:
+            return HTTPResponse(response.status, await response.read())
+    
+    def post(self, url, json=None, files=None, headers=None, timeout=30):
+        start = time.perf_counter()
+        try:
+            return get_io_runtime().run(self._post(url, json, files, headers, timeout), timeout=timeout + 5)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.request_count += 1
+                self.total_latency += elapsed
+    
+    def connection_count(self):
+        """累计新建的连接数"""
+        return self.connections
+    
+    def stats(self):
+        with self._lock:
+            requests_sent = self.request_count
+            total_latency = self.total_latency
+        connections = self.connection_count()
+        return {
+            "proxy_url": self.proxy_url,
+            "requests": requests_sent,
+            "connections": connections,
+            "reuse_rate": 1 - connections / requests_sent if requests_sent else 0.0,
+            "avg_latency_ms": total_latency / requests_sent * 1000 if requests_sent else 0.0,
+        }
+    
+    async def aclose(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+# 按proxy_url复用的HTTP会话，跨节点执行保持
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+def get_http_session(proxy_url):
+    """获取proxy_url对应的持久会话，不存在时创建"""
+    with _http_sessions_lock:
+        session = _http_sessions.get(proxy_url)
+        if session is None:
+            session = PooledHTTPSession(proxy_url)
+            _http_sessions[proxy_url] = session
+        return session
+
+def get_http_pool_stats():
+    """所有代理会话的连接复用和延迟统计"""
+    with _http_sessions_lock:
+        sessions = list(_http_sessions.values())
+    return [session.stats() for session in sessions]
+
+async def _close_http_sessions():
+    with _http_sessions_lock:
+        sessions = list(_http_sessions.values())
+        _http_sessions.clear()
+    for session in sessions:
+        await session.aclose()
+
+def close_http_sessions():
+    """关闭所有持久会话及其连接"""
+    get_io_runtime().run(_close_http_sessions(), timeout=10)
+
+# I/O事件循环关闭时一并关闭会话
+get_io_runtime().on_shutdown(_close_http_sessions)
+
+# 后台发送队列容量（任务数，一个任务为一次节点执行的全部图像）
+SEND_QUEUE_SIZE = int(os.environ.get("IMAGE_WS_QUEUE_SIZE", "32"))
+SEND_QUEUE_WORKERS = int(os.environ.get("IMAGE_WS_QUEUE_WORKERS", "2"))
+
+def _default_spill_dir():
+    # ComfyUI启动时会清空temp目录，遗留任务放在user目录下才能在重启后读回
+    if folder_paths is not None:
+        return os.path.join(folder_paths.get_user_directory(), "image_ws_spill")
+    return os.path.join(os.path.expanduser("~"), ".cache", "comfyui_image_ws_spill")
+
+# spill策略下队列满时任务写入的目录（仅当前用户可访问）
+SEND_QUEUE_SPILL_DIR = os.environ.get("IMAGE_WS_SPILL_DIR") or _default_spill_dir()
+# 进程退出时等待队列发送完毕的最长时间（秒），超时后剩余任务写入磁盘
+SEND_QUEUE_FLUSH_TIMEOUT = float(os.environ.get("IMAGE_WS_FLUSH_TIMEOUT", "30"))
+
+# 队列满时的处理策略
+QUEUE_POLICIES = ["block", "drop_oldest", "spill"]
+
+# 保留投递状态的prompt_id数量
+_STATUS_HISTORY = 256
+
+def _ensure_private_dir(path):
+    """创建仅当前用户可访问(0o700)的目录并检查其所有者，不安全时返回False
+
+    已存在的目录必须是当前用户拥有的真实目录（不是符号链接），
+    权限过宽时收紧为0o700。
+    """
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        info = os.lstat(path)
+        if not stat.S_ISDIR(info.st_mode):
+            print(f"[ImageWebSocketOutput] 磁盘队列目录不是普通目录，已禁用: {path}")
+            return False
+        if hasattr(os, "getuid"):
+            if info.st_uid != os.getuid():
+                print(f"[ImageWebSocketOutput] 磁盘队列目录不属于当前用户，已禁用: {path}")
+                return False
+            if info.st_mode & 0o077:
+                os.chmod(path, 0o700)
+        return True
+    except OSError as e:
+        print(f"[ImageWebSocketOutput] 无法创建磁盘队列目录 {path}: {e}")
+        return False
+
+class SendQueue:
+    """ImageWebSocketOutput的后台发送队列：有界队列 + 工作线程池
+    
+    队列满时按策略处理：block阻塞执行线程直到有空位，drop_oldest丢弃最早的任务，
+    spill把任务写入磁盘，待队列有空位时再读回（上次退出时留下的任务在启动时读回）。
+    每个写入磁盘的任务是一个子目录：job.json保存元数据，每张图像的编码字节保存为
+    <序号>.bin，读回时不会执行任何代码。投递状态按prompt_id统计图像数量。
+    """
+    
+    def __init__(self, maxsize, workers, spill_dir):
+        self.queue = queue.Queue(maxsize)
+        self.workers = workers
+        self.spill_dir = spill_dir
+        self._spilled = deque()
+        self._status = OrderedDict()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+    
+    def start(self):
+        """启动工作线程并读回磁盘上遗留的任务（只执行一次）"""
+        with self._lock:
+            if self._threads:
+                return
+            for _ in range(max(1, self.workers)):
+                thread = threading.Thread(target=self._worker, name="ImageWebSocketSend", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        
+        if os.path.isdir(self.spill_dir) and _ensure_private_dir(self.spill_dir):
+            with self._spill_lock:
+                for name in sorted(os.listdir(self.spill_dir)):
+                    path = os.path.join(self.spill_dir, name)
+                    try:
+                        job = self._load_job(path)
+                    except Exception as e:
+                        print(f"[ImageWebSocketOutput] 无法读取遗留的发送任务 {path}: {e}")
+                        continue
+                    count = len(job["encoded_images"])
+                    self._track(job, queued=count, spilled=count)
+                    self._spilled.append(path)
+            if self._spilled:
+                print(f"[ImageWebSocketOutput] 读回 {len(self._spilled)} 个遗留的发送任务")
+    
+    def _track(self, job, **deltas):
+        prompt_id = job["shared_metadata"].get("prompt_id") or ""
+        with self._lock:
+            status = self._status.get(prompt_id)
+            if status is None:
+                status = {"queued": 0, "spilled": 0, "sent": 0, "failed": 0, "dropped": 0}
+                self._status[prompt_id] = status
+                while len(self._status) > _STATUS_HISTORY:
+                    self._status.popitem(last=False)
+            else:
+                self._status.move_to_end(prompt_id)
+            for key, delta in deltas.items():
+                status[key] += delta
+    
+    def _spill(self, job):
+        """把任务写入磁盘，目录不安全或写入失败时返回False"""
+        if not _ensure_private_dir(self.spill_dir):
+            return False
+        # 目录名以时间戳开头，读回时按提交顺序排列
+        path = os.path.join(self.spill_dir, f"{time.time_ns()}_{uuid.uuid4().hex}")
+        try:
+            os.mkdir(path, 0o700)
+            for i, image_bytes in job["encoded_images"]:
+                with open(os.path.join(path, f"{i}.bin"), "wb") as f:
+                    f.write(image_bytes)
+            metadata = {key: value for key, value in job.items() if key != "encoded_images"}
+            metadata["image_indices"] = [i for i, _ in job["encoded_images"]]
+            # job.json最后写入，中途退出留下的不完整任务在读回时会被跳过
+            with open(os.path.join(path, "job.json.tmp"), "w", encoding="utf-8") as f:
+                json.dump(metadata, f)
+            os.replace(os.path.join(path, "job.json.tmp"), os.path.join(path, "job.json"))
+        except (OSError, TypeError, ValueError) as e:
+            print(f"[ImageWebSocketOutput] 无法把发送任务写入磁盘: {e}")
+            shutil.rmtree(path, ignore_errors=True)
+            return False
+        self._spilled.append(path)
+        self._track(job, spilled=len(job["encoded_images"]))
+        return True
+    
+    @staticmethod
+    def _load_job(path):
+        """读回磁盘上的任务；图像文件名由序号生成，不使用文件中的路径"""
+        with open(os.path.join(path, "job.json"), encoding="utf-8") as f:
+            job = json.load(f)
+        encoded_images = []
+        for i in job.pop("image_indices"):
+            with open(os.path.join(path, f"{int(i)}.bin"), "rb") as f:
+                encoded_images.append((int(i), f.read()))
+        job["encoded_images"] = encoded_images
+        return job
+    
+    def _restore_spilled(self):
+        """队列有空位时把磁盘上的任务按顺序读回队列"""
+        with self._spill_lock:
+            while self._spilled and not self.queue.full():
+                path = self._spilled[0]
+                try:
+                    job = self._load_job(path)
+                except Exception as e:
+                    print(f"[ImageWebSocketOutput] 无法读取磁盘上的发送任务 {path}: {e}")
+                    self._spilled.popleft()
+                    continue
+                try:
+                    self.queue.put_nowait(job)
+                except queue.Full:
+                    break
+                self._spilled.popleft()
+                shutil.rmtree(path, ignore_errors=True)
+                self._track(job, spilled=-len(job["encoded_images"]))
+    
+    def submit(self, job, policy="block"):
+        """提交一个发送任务，返回入队方式的描述"""
+        self.start()
+        count = len(job["encoded_images"])
+        self._track(job, queued=count)
+        
+        if policy == "block":
+            self.queue.put(job)
+            return "queued"
+        
+        with self._spill_lock:
+            # 已有任务在磁盘上时继续写入磁盘，保持发送顺序
+            if policy == "spill" and self._spilled and self._spill(job):
+                return "spilled to disk"
+            try:
+                self.queue.put_nowait(job)
+                return "queued"
+            except queue.Full:
+                pass
+            
+            if policy == "spill" and self._spill(job):
+                return "spilled to disk"
+        
+        if policy == "spill":
+            # 无法写入磁盘时退回到阻塞等待
+            self.queue.put(job)
+            return "queued (spill unavailable)"
+        
+        # drop_oldest
+        try:
+            dropped = self.queue.get_nowait()
+            self.queue.task_done()
+            dropped_count = len(dropped["encoded_images"])
+            self._track(dropped, queued=-dropped_count, dropped=dropped_count)
+            print(f"[ImageWebSocketOutput] 发送队列已满，丢弃最早的任务 ({dropped_count} 张图像)")
+        except queue.Empty:
+            pass
+        self.queue.put(job)
+        return "dropped oldest"
+    
+    def _worker(self):
+        while True:
+            try:
+                job = self.queue.get(timeout=1.0)
+            except queue.Empty:
+                self._restore_spilled()
+                continue
+            
+            count = len(job["encoded_images"])
+            try:
+                results = ImageWebSocketOutput().deliver(**job)
+                sent = sum(1 for success, _ in results.values() if success)
+            except Exception as e:
+                print(f"[ImageWebSocketOutput] 后台发送失败: {e}")
+                sent = 0
+            finally:
+                self.queue.task_done()
+            self._track(job, queued=-count, sent=sent, failed=count - sent)
+            self._restore_spilled()
+    
+    def pending(self):
+        """尚未发送完成的任务数（包括队列中、正在发送和磁盘上的任务）"""
+        return self.queue.unfinished_tasks + len(self._spilled)
+    
+    def status(self, prompt_id=None):
+        """按prompt_id返回投递状态；不指定时返回所有记录"""
+        with self._lock:
+            if prompt_id is not None:
+                status = self._status.get(prompt_id)
+                return dict(status) if status else None
+            return {key: dict(value) for key, value in self._status.items()}
+    
+    def flush(self, timeout):
+        """等待队列发送完毕；超时后把仍在内存队列中的任务写入磁盘，下次启动时继续发送"""
+        deadline = time.monotonic() + timeout
+        while self.pending() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if not self.pending():
+            return True
+        
+        spilled = 0
+        with self._spill_lock:
+            while True:
+                try:
+                    job = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                self.queue.task_done()
+                if self._spill(job):
+                    spilled += 1
+                else:
+                    count = len(job["encoded_images"])
+                    self._track(job, queued=-count, dropped=count)
+        print(f"[ImageWebSocketOutput] 发送队列未在 {timeout} 秒内清空，{spilled} 个任务已写入 {self.spill_dir}")
+        return False
+
+_send_queue = None
+_send_queue_lock = threading.Lock()
+
+def get_send_queue():
+    """获取进程级共享的后台发送队列，首次使用时创建并注册退出时的flush"""
+    global _send_queue
+    with _send_queue_lock:
+        if _send_queue is None:
+            _send_queue = SendQueue(SEND_QUEUE_SIZE, SEND_QUEUE_WORKERS, SEND_QUEUE_SPILL_DIR)
+            # atexit按注册的逆序执行，flush会在I/O事件循环关闭（及HTTP会话关闭）之前运行
+            atexit.register(flush_send_queue)
+        return _send_queue
+
+def flush_send_queue(timeout=None):
+    """等待后台发送队列清空，返回是否全部发送完成"""
+    if _send_queue is None:
+        return True
+    return _send_queue.flush(SEND_QUEUE_FLUSH_TIMEOUT if timeout is None else timeout)
+
+def get_send_status(prompt_id=None):
+    """后台发送的投递状态（按prompt_id统计图像数量）"""
+    if _send_queue is None:
+        return None if prompt_id is not None else {}
+    return _send_queue.status(prompt_id)
+
+# 可选的输出格式: 名称 -> (PIL格式, MIME类型, 文件扩展名)
+IMAGE_FORMATS = {
+    "png": ("PNG", "image/png", "png"),
+    "webp": ("WEBP", "image/webp", "webp"),
+    "jpeg": ("JPEG", "image/jpeg", "jpg"),
+}
+
+# 批量编码线程池；PIL在压缩时释放GIL，多张图像可以并行编码
+_encode_executor = None
+_encode_executor_lock = threading.Lock()
+
+def get_encode_executor():
+    global _encode_executor
+    with _encode_executor_lock:
+        if _encode_executor is None:
+            _encode_executor = ThreadPoolExecutor(
+                max_workers=min(8, os.cpu_count() or 1),
+                thread_name_prefix="ImageWebSocketEncode",
+            )
+        return _encode_executor
+
+# images_to_uint8每次转换的像素数，浮点临时张量的大小不超过这么多像素
+_CONVERT_BLOCK_PIXELS = 1 << 20
+
+def images_to_uint8(images):
+    """把 [B,H,W,C]（或单张 [H,W,C]、蒙版 [B,H,W]）图像张量转换为 [B,H,W,C] uint8数组
+    
+    取值超过1的图像视为已是0-255范围。单通道图像扩展为RGB。
+    按行块缩放后直接写入预先分配的uint8数组，浮点临时张量只有一个行块大小。
+    """
+    images = images.detach()
+    if images.dim() == 3 and images.shape[-1] in (1, 3, 4):
+        images = images.unsqueeze(0)
+    if images.dim() == 3:
+        images = images.unsqueeze(-1)
+    
+    batch, height, width, channels = images.shape
+    out_channels = 3 if channels == 1 else channels
+    out = torch.empty((batch, height, width, out_channels), dtype=torch.uint8)
+    
+    # 逐张判断取值范围
+    peaks = images.reshape(batch, -1).amax(dim=1).tolist() if images.numel() else [0.0] * batch
+    rows = max(1, _CONVERT_BLOCK_PIXELS // max(width, 1))
+    for i, peak in enumerate(peaks):
+        scale = 1.0 if peak > 1.0 else 255.0
+        for top in range(0, height, rows):
+            block = images[i, top:top + rows] * scale
+            block.clamp_(0, 255)
+            # copy_同时完成类型转换（截断，与 .to(torch.uint8) 一致）、设备拷贝和单通道扩展
+            out[i, top:top + rows].copy_(block.expand(-1, -1, out_channels))
+    return out.numpy()
+
+def encode_image_array(array, image_format="png", compress_level=6, quality=90):
+    """把 [H,W,C] uint8数组编码为所选格式的字节"""
+    pil_format = IMAGE_FORMATS[image_format][0]
+    pil_image = Image.fromarray(array)
+    options = {}
+    if pil_format == "PNG":
+        options["compress_level"] = compress_level
+    else:
+        options["quality"] = quality
+        if pil_format == "JPEG" and pil_image.mode == "RGBA":
+            pil_image = pil_image.convert("RGB")
+    buffer = BytesIO()
+    pil_image.save(buffer, format=pil_format, **options)
+    return buffer.getvalue()
+
+
+# 每个代理已上传的工作流引用（代理地址 -> 有序的引用集合）
+_WORKFLOW_REF_HISTORY = 64
+_uploaded_workflow_refs = {}
+_workflow_refs_lock = threading.Lock()
+
+# 同一次执行中的多个输出节点共享同一个工作流对象，缓存其引用以免重复序列化和哈希
+_workflow_ref_memo = OrderedDict()
+
+def workflow_reference(workflow_info, prompt_id=None):
+    """工作流数据的内容哈希，作为workflow_ref"""
+    memo_key = (prompt_id, id(workflow_info)) if prompt_id else None
+    if memo_key is not None:
+        with _workflow_refs_lock:
+            cached = _workflow_ref_memo.get(memo_key)
+        if cached is not None and cached[0] is workflow_info:
+            return cached[1]
+    
+    serialized = json.dumps(workflow_info, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    workflow_ref = payload_digest(serialized)
+    if memo_key is not None:
+        with _workflow_refs_lock:
+            # 同时保存对象本身，保证id不会被其他对象复用
+            _workflow_ref_memo[memo_key] = (workflow_info, workflow_ref)
+            while len(_workflow_ref_memo) > _WORKFLOW_REF_HISTORY:
+                _workflow_ref_memo.popitem(last=False)
+    return workflow_ref
+
+# 工作流数据和prompt_id的来源统计，用于观察调用栈遍历这类昂贵的回退路径何时被触发
+_discovery_stats = {
+    "workflow": {"thread_local": 0, "hidden_input": 0, "cache": 0, "prompt_server": 0,
+                 "execution_module": 0, "stack_walk": 0, "not_found": 0},
+    "prompt_id": {"prompt_server": 0, "execution_module": 0, "environment": 0,
+                  "stack_walk": 0, "not_found": 0},
+    "stack_walk_ms": 0.0,
+}
+_discovery_lock = threading.Lock()
+
+# 运行时探测到的工作流数据，按prompt_id缓存
+_DISCOVERY_CACHE_SIZE = 32
+_discovered_workflows = OrderedDict()
+
+def _record_discovery(kind, source):
+    with _discovery_lock:
+        _discovery_stats[kind][source] += 1
+
+def get_discovery_stats():
+    """工作流数据和prompt_id各来源的命中次数，以及调用栈遍历的累计耗时"""
+    with _discovery_lock:
+        return {
+            "workflow": dict(_discovery_stats["workflow"]),
+            "prompt_id": dict(_discovery_stats["prompt_id"]),
+            "stack_walk_ms": _discovery_stats["stack_walk_ms"],
+        }
+
+def walk_stack_for(kind, var_names, accept, max_depth=None):
+    """在调用栈的局部和全局变量中查找第一个满足accept的变量，返回 (变量名, 值)
+    
+    直接沿frame.f_back遍历，不像inspect.stack()那样为每一帧读取源码上下文。
+    每次调用都会计数、计时并打印警告，便于发现依赖这条回退路径的情况。
+    """
+    start = time.perf_counter()
+    frame = sys._getframe(1)
+    depth = 0
+    found = (None, None)
+    try:
+        while frame is not None and (max_depth is None or depth < max_depth):
+            frame_locals = frame.f_locals
+            frame_globals = frame.f_globals
+            for var_name in var_names:
+                for scope in (frame_locals, frame_globals):
+                    value = scope.get(var_name)
+                    if value and accept(value):
+                        found = (var_name, value)
+                        return found
+            frame = frame.f_back
+            depth += 1
+        return found
+    finally:
+        del frame
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with _discovery_lock:
+            _discovery_stats[kind]["stack_walk"] += 1
+            _discovery_stats["stack_walk_ms"] += elapsed_ms
+        print(f"[ImageWebSocketOutput] 警告: 通过遍历调用栈查找{kind} "
+              f"({'找到' if found[0] else '未找到'}, {depth + 1 if found[0] else depth} 帧, {elapsed_ms:.2f} ms)，"
+              f"建议通过隐藏输入或workflow_data提供")
+
+
 def set_current_workflow(workflow_data):
     """设置当前线程的工作流数据"""
     _current_workflow_data.workflow = workflow_data
@@ -49,7 +682,33 @@ class ImageWebSocketOutput:
                     "multiline": True,
                     "placeholder": "工作流JSON数据（可选）"
                 }),
-            }
+                # json: 图像base64嵌入JSON（兼容旧代理）
+                # multipart: 原始图像字节 + JSON元数据部分，代理不支持时自动回退到json
+                "transport": (["json", "multipart"], {"default": "json"}),
+                # per_image: 每张图像一个请求
+                # batch: 整个批次一个请求，共享的工作流数据只发送一次，代理不支持时自动回退到per_image
+                "send_mode": (["per_image", "batch"], {"default": "per_image"}),
+                # inline: 每条消息内嵌完整的workflow_data
+                # reference: 工作流按内容哈希只上传一次，消息中只带workflow_ref，代理不支持时自动回退到inline
+                "workflow_transfer": (["inline", "reference"], {"default": "inline"}),
+                # blocking: 等待发送完成后返回
+                # background: 编码后放入后台发送队列立即返回，不阻塞执行线程
+                "delivery": (["blocking", "background"], {"default": "blocking"}),
+                # 后台队列满时的处理方式
+                "queue_policy": (QUEUE_POLICIES, {"default": "block"}),
+                # 预览时可用webp/jpeg减小体积
+                "image_format": (list(IMAGE_FORMATS), {"default": "png"}),
+                # PNG压缩级别，0最快、9最小
+                "compress_level": ("INT", {"default": 6, "min": 0, "max": 9}),
+                # webp/jpeg质量
+                "quality": ("INT", {"default": 90, "min": 1, "max": 100}),
+            },
+            # 由执行器直接传入当前工作流和节点ID，避免运行时探测
+            "hidden": {
+                "prompt": "PROMPT",
+                "extra_pnginfo": "EXTRA_PNGINFO",
+                "unique_id": "UNIQUE_ID",
+            },
         }
     
     RETURN_TYPES = ("IMAGE", "STRING", "STRING")
@@ -59,34 +718,41 @@ class ImageWebSocketOutput:
     DISPLAY_NAME = "Image WebSocket Output"
     OUTPUT_NODE = True
     
-    def tensor_to_base64(self, tensor):
-        """将tensor转换为base64字符串"""
+    def tensor_to_png_bytes(self, tensor):
+        """将tensor转换为PNG字节"""
         try:
-            # 确保tensor在正确的范围内 [0, 1]
-            if tensor.max() > 1.0:
-                tensor = tensor / 255.0
-            
-            # 转换为numpy数组并调整到[0, 255]范围
-            numpy_image = (tensor.squeeze().cpu().numpy() * 255).astype(np.uint8)
-            
-            # 如果是单通道图像，转换为RGB
-            if len(numpy_image.shape) == 2:
-                numpy_image = np.stack([numpy_image] * 3, axis=-1)
-            elif len(numpy_image.shape) == 3 and numpy_image.shape[2] == 1:
-                numpy_image = np.repeat(numpy_image, 3, axis=2)
-            
-            # 创建PIL图像
-            pil_image = Image.fromarray(numpy_image)
-            
-            # 转换为base64
-            buffer = BytesIO()
-            pil_image.save(buffer, format='PNG')
-            image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-            
-            return image_base64
+            return encode_image_array(images_to_uint8(tensor)[0])
         except Exception as e:
-            print(f"[ImageWebSocketOutput] 转换图像为base64失败: {e}")
+            print(f"[ImageWebSocketOutput] 转换图像为PNG失败: {e}")
+            return None
+    
+    def encode_images(self, images, image_format="png", compress_level=6, quality=90):
+        """批量编码图像：整个批次一次转换为uint8，再在线程池中并行编码
+        
+        返回 ([(image_index, 字节)], [失败的image_index])，成功列表保持原顺序。
+        """
+        arrays = images_to_uint8(images)
+        executor = get_encode_executor()
+        futures = [
+            executor.submit(encode_image_array, array, image_format, compress_level, quality)
+            for array in arrays
+        ]
+        encoded_images = []
+        failed = []
+        for i, future in enumerate(futures):
+            try:
+                encoded_images.append((i, future.result()))
+            except Exception as e:
+                print(f"[ImageWebSocketOutput] 编码图像 {i+1} 失败: {e}")
+                failed.append(i)
+        return encoded_images, failed
+    
+    def tensor_to_base64(self, tensor):
+        """将tensor转换为base64字符串"""
+        image_bytes = self.tensor_to_png_bytes(tensor)
+        if image_bytes is None:
             return None
+        return base64.b64encode(image_bytes).decode('utf-8')
     
     def send_http_message(self, message, proxy_url):
         """通过HTTP POST发送消息到proxy_server"""
@@ -94,8 +760,8 @@ class ImageWebSocketOutput:
             # 构建完整的URL
             url = f"{proxy_url}/api/image-message"
             
-            # 发送POST请求
-            response = requests.post(
+            # 通过持久会话发送POST请求（复用keep-alive连接）
+            response = get_http_session(proxy_url).post(
                 url,
                 json=message,
                 headers={'Content-Type': 'application/json'},
@@ -107,9 +773,11 @@ class ImageWebSocketOutput:
                 return True
             else:
                 print(f"[ImageWebSocketOutput] HTTP请求失败，状态码: {response.status_code}")
+                self.last_error = f"HTTP {response.status_code}"
+                self.check_workflow_ref(response, message)
                 return False
                 
-        except requests.exceptions.RequestException as e:
+        except HTTP_ERRORS as e:
             print(f"[ImageWebSocketOutput] HTTP请求异常: {e}")
             self.last_error = str(e)
             return False
@@ -118,7 +786,397 @@ class ImageWebSocketOutput:
             self.last_error = str(e)
             return False
         
-    def send_image(self, images, react_node_id, proxy_url="http://localhost:3078", workflow_data=""):
+    def send_multipart_message(self, message, image_bytes, proxy_url):
+        """以multipart/form-data发送原始图像字节和JSON元数据
+
+        返回True/False表示发送结果；代理不支持该格式时返回None。
+        """
+        try:
+            url = f"{proxy_url}/api/image-message"
+            index = message.get('image_index', 0)
+            _, mime_type, extension = IMAGE_FORMATS[message.get('image_format', 'png')]
+            response = get_http_session(proxy_url).post(
+                url,
+                files={
+                    "metadata": (None, json.dumps(message), "application/json"),
+                    "image": (f"image_{index}.{extension}", image_bytes, mime_type),
+                },
+                timeout=30
+            )
+            
+            if response.status_code == 200:
+                print(f"[ImageWebSocketOutput] multipart消息发送成功: {message.get('type', 'unknown')}")
+                return True
+            if is_unsupported_response(response, "multipart"):
+                print(f"[ImageWebSocketOutput] 代理不支持multipart (状态码: {response.status_code})，回退到JSON格式")
+                return None
+            print(f"[ImageWebSocketOutput] multipart请求失败，状态码: {response.status_code}")
+            self.last_error = f"HTTP {response.status_code}"
+            self.check_workflow_ref(response, message)
+            return False
+            
+        except HTTP_ERRORS as e:
+            print(f"[ImageWebSocketOutput] multipart请求异常: {e}")
+            self.last_error = str(e)
+            return False
+    
+    def send_image_message(self, message, image_bytes, proxy_url, transport="json"):
+        """按所选传输方式发送一张图像，multipart不可用时回退到JSON内嵌base64"""
+        if transport == "multipart" and _proxy_capabilities.supports(proxy_url, "multipart"):
+            result = self.send_multipart_message(message, image_bytes, proxy_url)
+            if result is not None:
+                return result
+            _proxy_capabilities.mark_unsupported(proxy_url, "multipart")
+        
+        message = dict(message, image_data=base64.b64encode(image_bytes).decode('utf-8'))
+        return self.send_http_message(message, proxy_url)
+    
+    def split_batch(self, encoded_images, transport):
+        """按编码后的大小把图像分成若干块，每块不超过BATCH_MAX_BYTES（单张超限的图像独占一块）"""
+        chunks = []
+        current = []
+        current_bytes = 0
+        for i, image_bytes in encoded_images:
+            # JSON传输时图像以base64内嵌，体积约为原始字节的4/3
+            size = len(image_bytes) if transport == "multipart" else (len(image_bytes) + 2) // 3 * 4
+            if current and current_bytes + size > BATCH_MAX_BYTES:
+                chunks.append(current)
+                current = []
+                current_bytes = 0
+            current.append((i, image_bytes))
+            current_bytes += size
+        if current:
+            chunks.append(current)
+        return chunks
+    
+    def post_batch_message(self, message, chunk, proxy_url, transport):
+        """发送一个批量分块，返回响应；代理不支持批量消息时返回None"""
+        url = f"{proxy_url}/api/image-batch-message"
+        session = get_http_session(proxy_url)
+        
+        if transport == "multipart" and _proxy_capabilities.supports(proxy_url, "multipart"):
+            _, mime_type, extension = IMAGE_FORMATS[message.get("image_format", "png")]
+            metadata = dict(message, images=[{"image_index": i, "field": f"image_{i}"} for i, _ in chunk])
+            files = [("metadata", (None, json.dumps(metadata), "application/json"))]
+            files.extend((f"image_{i}", (f"image_{i}.{extension}", image_bytes, mime_type))
+                         for i, image_bytes in chunk)
+            response = session.post(url, files=files, timeout=30)
+            if not is_unsupported_response(response, "multipart", statuses=(415,)):
+                return None if is_unsupported_response(response, "batch", statuses=(404, 405)) else response
+            print("[ImageWebSocketOutput] 代理不支持multipart批量消息，回退到JSON格式")
+            _proxy_capabilities.mark_unsupported(proxy_url, "multipart")
+        
+        message = dict(message, images=[
+            {"image_index": i, "image_data": base64.b64encode(image_bytes).decode('utf-8')}
+            for i, image_bytes in chunk
+        ])
+        response = session.post(url, json=message, timeout=30)
+        if is_unsupported_response(response, "batch"):
+            return None
+        return response
+    
+    def send_batches(self, encoded_images, shared_metadata, total_images, proxy_url, transport, results):
+        """以批量消息发送图像，每个分块只携带一份共享元数据
+        
+        每张图像的结果写入results。代理可在响应中返回
+        {"results": [{"image_index": i, "success": bool, "error": str}]} 报告单张结果，
+        否则分块内所有图像按整个请求的结果记录。
+        返回未能以批量方式发送、需要逐张发送的图像列表（代理不支持批量消息时）。
+        """
+        chunks = self.split_batch(encoded_images, transport)
+        for chunk_index, chunk in enumerate(chunks):
+            message = dict(
+                shared_metadata,
+                type="image_websocket_output_batch",
+                timestamp=int(time.time() * 1000),
+                total_images=total_images,
+                chunk_index=chunk_index,
+                chunk_count=len(chunks),
+            )
+            print(f"[ImageWebSocketOutput] 批量发送分块 {chunk_index+1}/{len(chunks)} "
+                  f"({len(chunk)} 张图像) 到节点 {shared_metadata['react_node_id']}")
+            try:
+                response = self.post_batch_message(message, chunk, proxy_url, transport)
+            except HTTP_ERRORS as e:
+                print(f"[ImageWebSocketOutput] 批量请求异常: {e}")
+                self.last_error = str(e)
+                for i, _ in chunk:
+                    results[i] = (False, self.last_error)
+                continue
+            
+            if response is None:
+                print("[ImageWebSocketOutput] 代理不支持批量消息，回退到逐张发送")
+                _proxy_capabilities.mark_unsupported(proxy_url, "batch")
+                return [item for remaining in chunks[chunk_index:] for item in remaining]
+            
+            if response.status_code != 200:
+                self.last_error = f"HTTP {response.status_code}"
+                print(f"[ImageWebSocketOutput] 批量请求失败，状态码: {response.status_code}")
+                self.check_workflow_ref(response, message)
+                for i, _ in chunk:
+                    results[i] = (False, self.last_error)
+                continue
+            
+            try:
+                image_results = response.json().get("results") or []
+            except ValueError:
+                image_results = []
+            reported = {
+                item["image_index"]: (bool(item.get("success")), item.get("error", ""))
+                for item in image_results if isinstance(item, dict) and "image_index" in item
+            }
+            for i, _ in chunk:
+                results[i] = reported.get(i, (True, ""))
+        return []
+    
+    def resolve_workflow_info(self, workflow_data, prompt=None, extra_pnginfo=None, prompt_id=None):
+        """获取要随图像发送的工作流数据
+        
+        优先级：手动输入 > 线程本地存储 > ComfyUI隐藏输入(PROMPT/EXTRA_PNGINFO) > 运行时探测。
+        运行时探测的结果按prompt_id缓存，同一次执行中的其他输出节点直接复用。
+        """
+        # 首先尝试从手动输入获取工作流数据
+        if workflow_data and workflow_data.strip():
+            try:
+                return json.loads(workflow_data.strip())
+            except json.JSONDecodeError:
+                print("[ImageWebSocketOutput] 工作流数据JSON格式无效，将作为字符串发送")
+                return workflow_data.strip()
+        
+        # 从线程本地存储获取
+        workflow_info = get_current_workflow()
+        if workflow_info:
+            _record_discovery("workflow", "thread_local")
+            return workflow_info
+        
+        # 由执行器传入的隐藏输入，无需任何探测
+        if prompt:
+            _record_discovery("workflow", "hidden_input")
+            return prompt
+        if isinstance(extra_pnginfo, dict) and extra_pnginfo.get("workflow"):
+            _record_discovery("workflow", "hidden_input")
+            return extra_pnginfo["workflow"]
+        
+        if prompt_id is not None:
+            with _discovery_lock:
+                if prompt_id in _discovered_workflows:
+                    _discovered_workflows.move_to_end(prompt_id)
+                    _discovery_stats["workflow"]["cache"] += 1
+                    return _discovered_workflows[prompt_id]
+        
+        workflow_info = self.probe_workflow_info()
+        if prompt_id is not None:
+            with _discovery_lock:
+                _discovered_workflows[prompt_id] = workflow_info
+                while len(_discovered_workflows) > _DISCOVERY_CACHE_SIZE:
+                    _discovered_workflows.popitem(last=False)
+        return workflow_info
+    
+    def probe_workflow_info(self):
+        """没有隐藏输入时（例如不在ComfyUI执行器中调用）探测当前工作流"""
+        # 方法1: 尝试从PromptServer获取当前执行的工作流
+        try:
+            from server import PromptServer
+            prompt_server = PromptServer.instance
+            if hasattr(prompt_server, 'prompt_queue') and prompt_server.prompt_queue:
+                # 尝试不同的方法获取当前项
+                current_item = None
+                if hasattr(prompt_server.prompt_queue, 'get_current'):
+                    current_item = prompt_server.prompt_queue.get_current()
+                elif hasattr(prompt_server.prompt_queue, 'currently_running'):
+                    current_item = prompt_server.prompt_queue.currently_running
+                elif hasattr(prompt_server.prompt_queue, 'queue') and prompt_server.prompt_queue.queue:
+                    # 获取队列中的第一个项目
+                    current_item = prompt_server.prompt_queue.queue[0] if prompt_server.prompt_queue.queue else None
+                
+                if current_item and len(current_item) > 2:
+                    _record_discovery("workflow", "prompt_server")
+                    print("[ImageWebSocketOutput] 从PromptServer获取到工作流数据")
+                    return current_item[2]  # 工作流数据通常在索引2
+        except Exception as e:
+            print(f"[ImageWebSocketOutput] 从PromptServer获取工作流数据失败: {e}")
+        
+        # 方法2: 尝试从execution模块获取
+        try:
+            import execution
+            if getattr(execution, 'current_prompt', None) is not None:
+                _record_discovery("workflow", "execution_module")
+                print("[ImageWebSocketOutput] 从execution模块获取到工作流数据")
+                return execution.current_prompt
+        except Exception as e:
+            print(f"[ImageWebSocketOutput] 从execution模块获取工作流数据失败: {e}")
+        
+        # 方法3（最后手段）: 遍历调用栈寻找可能包含工作流数据的变量
+        var_name, workflow_info = walk_stack_for(
+            "workflow", ['prompt', 'workflow', 'workflow_data', 'current_prompt'], lambda value: True
+        )
+        if workflow_info is not None:
+            print(f"[ImageWebSocketOutput] 从调用栈获取到工作流数据 (变量: {var_name})")
+            return workflow_info
+        
+        _record_discovery("workflow", "not_found")
+        print("[ImageWebSocketOutput] 无法自动获取工作流数据，将不包含工作流信息")
+        return None
+    
+    def resolve_prompt_id(self):
+        """获取当前执行的prompt_id，无法获取时返回None"""
+        # 方法1: 执行器在运行每个prompt前都会设置PromptServer.last_prompt_id
+        try:
+            from server import PromptServer
+            prompt_id = getattr(PromptServer.instance, 'last_prompt_id', None)
+            if prompt_id:
+                _record_discovery("prompt_id", "prompt_server")
+                return prompt_id
+        except Exception:
+            pass
+        
+        # 方法2: 从execution模块获取当前prompt_id
+        try:
+            import execution
+            if getattr(execution, 'current_prompt_id', None):
+                _record_discovery("prompt_id", "execution_module")
+                return execution.current_prompt_id
+            current_execution = getattr(execution, 'current_execution', None)
+            if current_execution is not None and getattr(current_execution, 'prompt_id', None):
+                _record_discovery("prompt_id", "execution_module")
+                return current_execution.prompt_id
+        except Exception:
+            pass
+        
+        # 方法3: 从环境变量获取
+        env_prompt_id = os.environ.get('COMFYUI_PROMPT_ID')
+        if env_prompt_id:
+            _record_discovery("prompt_id", "environment")
+            return env_prompt_id
+        
+        # 方法4（最后手段）: 在调用栈前10层中查找prompt_id
+        var_name, prompt_id = walk_stack_for(
+            "prompt_id", ['prompt_id', 'current_prompt_id', 'id', 'execution_id'],
+            lambda value: isinstance(value, str) and len(value) > 10,  # 简单验证
+            max_depth=10,
+        )
+        if prompt_id is not None:
+            print(f"[ImageWebSocketOutput] 从调用栈获取到prompt_id (变量: {var_name}): {prompt_id}")
+            return prompt_id
+        
+        _record_discovery("prompt_id", "not_found")
+        return None
+    
+    def check_workflow_ref(self, response, message):
+        """代理以409回应带workflow_ref的消息时，表示它不认识该引用（例如代理重启后）"""
+        if response.status_code == 409 and message.get("workflow_ref"):
+            print(f"[ImageWebSocketOutput] 代理不认识工作流引用 {message['workflow_ref']}")
+            self.workflow_ref_rejected = True
+    
+    def upload_workflow(self, workflow_ref, shared_metadata, proxy_url):
+        """上传工作流数据，返回True/False；代理不支持工作流引用时返回None"""
+        url = f"{proxy_url}/api/workflow-ref"
+        try:
+            response = get_http_session(proxy_url).post(url, json={
+                "workflow_ref": workflow_ref,
+                "prompt_id": shared_metadata.get("prompt_id"),
+                "workflow_data": shared_metadata["workflow_data"],
+            }, timeout=30)
+        except HTTP_ERRORS as e:
+            print(f"[ImageWebSocketOutput] 上传工作流失败: {e}")
+            return False
+        if response.status_code == 200:
+            print(f"[ImageWebSocketOutput] 工作流已上传，引用: {workflow_ref}")
+            return True
+        if is_unsupported_response(response, "workflow_ref"):
+            print(f"[ImageWebSocketOutput] 代理不支持工作流引用 (状态码: {response.status_code})，工作流将内嵌发送")
+            return None
+        print(f"[ImageWebSocketOutput] 上传工作流失败，状态码: {response.status_code}")
+        return False
+    
+    def attach_workflow_ref(self, shared_metadata, proxy_url, workflow_transfer="inline", force_upload=False):
+        """reference模式下把消息中的workflow_data替换为workflow_ref
+        
+        每个代理对同一工作流只上传一次；代理不支持或上传失败时保持内嵌发送。
+        """
+        if (workflow_transfer != "reference" or shared_metadata.get("workflow_data") is None
+                or not _proxy_capabilities.supports(proxy_url, "workflow_ref")):
+            return shared_metadata
+        
+        workflow_ref = workflow_reference(shared_metadata["workflow_data"], shared_metadata.get("prompt_id"))
+        with _workflow_refs_lock:
+            uploaded = _uploaded_workflow_refs.setdefault(proxy_url, OrderedDict())
+            known = workflow_ref in uploaded and not force_upload
+            if known:
+                uploaded.move_to_end(workflow_ref)
+        
+        if not known:
+            result = self.upload_workflow(workflow_ref, shared_metadata, proxy_url)
+            if result is None:
+                _proxy_capabilities.mark_unsupported(proxy_url, "workflow_ref")
+            if not result:
+                return shared_metadata
+            with _workflow_refs_lock:
+                uploaded[workflow_ref] = True
+                while len(uploaded) > _WORKFLOW_REF_HISTORY:
+                    uploaded.popitem(last=False)
+        
+        metadata = {key: value for key, value in shared_metadata.items() if key != "workflow_data"}
+        metadata["workflow_ref"] = workflow_ref
+        return metadata
+    
+    def deliver(self, encoded_images, shared_metadata, total_images, proxy_url, transport="json", send_mode="per_image",
+                workflow_transfer="inline"):
+        """发送已编码的图像，返回每张图像的结果: image_index -> (是否成功, 错误信息)
+        
+        代理不认识workflow_ref时重新上传工作流，并重发失败的图像一次。
+        """
+        self.workflow_ref_rejected = False
+        metadata = self.attach_workflow_ref(shared_metadata, proxy_url, workflow_transfer)
+        results = self.send_encoded(encoded_images, metadata, total_images, proxy_url, transport, send_mode)
+        
+        if self.workflow_ref_rejected:
+            self.workflow_ref_rejected = False
+            metadata = self.attach_workflow_ref(shared_metadata, proxy_url, workflow_transfer, force_upload=True)
+            retry = [(i, image_bytes) for i, image_bytes in encoded_images if not results.get(i, (False,))[0]]
+            print(f"[ImageWebSocketOutput] 重新上传工作流后重发 {len(retry)} 张图像")
+            results.update(self.send_encoded(retry, metadata, total_images, proxy_url, transport, send_mode))
+        return results
+    
+    def send_encoded(self, encoded_images, shared_metadata, total_images, proxy_url, transport="json", send_mode="per_image"):
+        """按所选模式发送已编码的图像，返回每张图像的结果"""
+        results = {}
+        pending = encoded_images
+        if send_mode == "batch" and _proxy_capabilities.supports(proxy_url, "batch"):
+            pending = self.send_batches(encoded_images, shared_metadata, total_images, proxy_url, transport, results)
+        
+        # 逐张发送（未启用批量模式，或代理不支持批量消息）
+        for i, image_bytes in pending:
+            try:
+                http_message = dict(shared_metadata, type="image_websocket_output",
+                                    timestamp=int(time.time() * 1000), image_index=i)
+                print(f"[ImageWebSocketOutput] 发送图像 {i+1}/{total_images} 到节点 {shared_metadata['react_node_id']}")
+                send_success = self.send_image_message(http_message, image_bytes, proxy_url, transport)
+                results[i] = (bool(send_success), "" if send_success else self.last_error)
+            except Exception as e:
+                results[i] = (False, f"处理失败: {str(e)}")
+        return results
+    
+    def log_results(self, results, message_log):
+        """把每张图像的发送结果写入message_log，返回成功数量"""
+        success_count = 0
+        for i in sorted(results):
+            send_success, error = results[i]
+            if send_success:
+                success_count += 1
+                success_msg = f"图像 {i+1} 发送成功"
+                message_log.append(success_msg)
+                print(f"[ImageWebSocketOutput] {success_msg}")
+            else:
+                error_msg = f"图像 {i+1} 发送失败: {error}"
+                message_log.append(f"错误: {error_msg}")
+                print(f"[ImageWebSocketOutput] {error_msg}")
+        return success_count
+    
+    def send_image(self, images, react_node_id, proxy_url="http://localhost:3078", workflow_data="", transport="json",
+                   send_mode="per_image", delivery="blocking", queue_policy="block",
+                   image_format="png", compress_level=6, quality=90,
+                   workflow_transfer="inline", prompt=None, extra_pnginfo=None, unique_id=None):
         """发送图像到proxy_server"""
         message_log = []
         
@@ -139,197 +1197,55 @@ class ImageWebSocketOutput:
             # 更新proxy URL
             self.proxy_url = proxy_url
             
-            # 处理图像批次
-            success_count = 0
-            for i, image_tensor in enumerate(images):
-                try:
-                    # 转换图像为base64
-                    image_base64 = self.tensor_to_base64(image_tensor)
-                    if image_base64 is None:
-                        error_msg = f"图像 {i+1} 转换失败"
-                        message_log.append(f"错误: {error_msg}")
-                        print(f"[ImageWebSocketOutput] {error_msg}")
-                        continue
-                    
-                    # 准备工作流数据
-                    workflow_info = None
-                    
-                    # 首先尝试从手动输入获取工作流数据
-                    if workflow_data and workflow_data.strip():
-                        try:
-                            workflow_info = json.loads(workflow_data.strip())
-                        except json.JSONDecodeError:
-                            print(f"[ImageWebSocketOutput] 工作流数据JSON格式无效，将作为字符串发送")
-                            workflow_info = workflow_data.strip()
-                    
-                    # 如果没有手动输入的工作流数据，尝试自动获取当前工作流
-                    if workflow_info is None:
-                        # 方法1: 从线程本地存储获取
-                        try:
-                            workflow_info = get_current_workflow()
-                            if workflow_info:
-                                print(f"[ImageWebSocketOutput] 从线程本地存储获取到工作流数据")
-                        except Exception as e:
-                            print(f"[ImageWebSocketOutput] 从线程本地存储获取工作流数据失败: {e}")
-                        
-                        # 方法2: 尝试从PromptServer获取当前执行的工作流
-                        if workflow_info is None:
-                            try:
-                                from server import PromptServer
-                                prompt_server = PromptServer.instance
-                                if hasattr(prompt_server, 'prompt_queue') and prompt_server.prompt_queue:
-                                    # 尝试不同的方法获取当前项
-                                    current_item = None
-                                    if hasattr(prompt_server.prompt_queue, 'get_current'):
-                                        current_item = prompt_server.prompt_queue.get_current()
-                                    elif hasattr(prompt_server.prompt_queue, 'currently_running'):
-                                        current_item = prompt_server.prompt_queue.currently_running
-                                    elif hasattr(prompt_server.prompt_queue, 'queue') and prompt_server.prompt_queue.queue:
-                                        # 获取队列中的第一个项目
-                                        current_item = prompt_server.prompt_queue.queue[0] if prompt_server.prompt_queue.queue else None
-                                    
-                                    if current_item and len(current_item) > 2:
-                                        workflow_info = current_item[2]  # 工作流数据通常在索引2
-                                        print(f"[ImageWebSocketOutput] 从PromptServer获取到工作流数据")
-                            except Exception as e:
-                                print(f"[ImageWebSocketOutput] 从PromptServer获取工作流数据失败: {e}")
-                                
-                        # 方法3: 如果方法1和2失败，尝试从execution模块获取
-                        if workflow_info is None:
-                            try:
-                                import execution
-                                if hasattr(execution, 'current_prompt') and execution.current_prompt is not None:
-                                    workflow_info = execution.current_prompt
-                                    print(f"[ImageWebSocketOutput] 从execution模块获取到工作流数据")
-                            except Exception as e:
-                                print(f"[ImageWebSocketOutput] 从execution模块获取工作流数据失败: {e}")
-                        
-                        # 方法4: 尝试通过inspect模块获取调用栈中的工作流信息
-                        if workflow_info is None:
-                            try:
-                                import inspect
-                                # 遍历调用栈寻找可能包含工作流数据的帧
-                                for frame_info in inspect.stack():
-                                    frame_locals = frame_info.frame.f_locals
-                                    frame_globals = frame_info.frame.f_globals
-                                    
-                                    # 查找可能的工作流数据变量
-                                    for var_name in ['prompt', 'workflow', 'workflow_data', 'current_prompt']:
-                                        if var_name in frame_locals and frame_locals[var_name]:
-                                            workflow_info = frame_locals[var_name]
-                                            print(f"[ImageWebSocketOutput] 从调用栈获取到工作流数据 (变量: {var_name})")
-                                            break
-                                        elif var_name in frame_globals and frame_globals[var_name]:
-                                            workflow_info = frame_globals[var_name]
-                                            print(f"[ImageWebSocketOutput] 从全局变量获取到工作流数据 (变量: {var_name})")
-                                            break
-                                    
-                                    if workflow_info:
-                                        break
-                            except Exception as e:
-                                print(f"[ImageWebSocketOutput] 从调用栈获取工作流数据失败: {e}")
-                        
-                        if workflow_info is None:
-                            print(f"[ImageWebSocketOutput] 无法自动获取工作流数据，将不包含工作流信息")
-                    
-                    # 尝试获取当前的prompt_id
-                    prompt_id = None
-                    print(f"[ImageWebSocketOutput] 开始获取prompt_id...")
-                    
-                    # 方法1: 从execution模块获取当前prompt_id
-                    try:
-                        import execution
-                        print(f"[ImageWebSocketOutput] 检查execution模块...")
-                        if hasattr(execution, 'current_prompt_id') and execution.current_prompt_id:
-                            prompt_id = execution.current_prompt_id
-                            print(f"[ImageWebSocketOutput] 从execution.current_prompt_id获取到: {prompt_id}")
-                        elif hasattr(execution, 'current_execution') and execution.current_execution:
-                            if hasattr(execution.current_execution, 'prompt_id'):
-                                prompt_id = execution.current_execution.prompt_id
-                                print(f"[ImageWebSocketOutput] 从execution.current_execution.prompt_id获取到: {prompt_id}")
-                        else:
-                            print(f"[ImageWebSocketOutput] execution模块中没有找到prompt_id相关属性")
-                    except Exception as e:
-                        print(f"[ImageWebSocketOutput] 从execution模块获取prompt_id失败: {e}")
-                    
-                    # 方法2: 从PromptServer获取已移除（性能优化）
-                    
-                    # 方法3: 尝试从全局变量或环境变量获取
-                    if prompt_id is None:
-                        try:
-                            import os
-                            env_prompt_id = os.environ.get('COMFYUI_PROMPT_ID')
-                            if env_prompt_id:
-                                prompt_id = env_prompt_id
-                                print(f"[ImageWebSocketOutput] 从环境变量获取到prompt_id: {prompt_id}")
-                        except Exception as e:
-                            print(f"[ImageWebSocketOutput] 从环境变量获取prompt_id失败: {e}")
-                    
-                    # 方法4: 尝试从调用栈中查找prompt_id (优化性能)
-                    if prompt_id is None:
-                        try:
-                            import inspect
-                            # 限制搜索深度以提高性能
-                            stack_frames = inspect.stack()[:10]  # 只检查前10层调用栈
-                            for frame_info in stack_frames:
-                                frame_locals = frame_info.frame.f_locals
-                                frame_globals = frame_info.frame.f_globals
-                                
-                                # 查找可能的prompt_id变量
-                                for var_name in ['prompt_id', 'current_prompt_id', 'id', 'execution_id']:
-                                    if var_name in frame_locals and frame_locals[var_name]:
-                                        potential_id = frame_locals[var_name]
-                                        if isinstance(potential_id, str) and len(potential_id) > 10:  # 简单验证
-                                            prompt_id = potential_id
-                                            print(f"[ImageWebSocketOutput] 从调用栈获取到prompt_id (变量: {var_name}): {prompt_id}")
-                                            break
-                                    elif var_name in frame_globals and frame_globals[var_name]:
-                                        potential_id = frame_globals[var_name]
-                                        if isinstance(potential_id, str) and len(potential_id) > 10:  # 简单验证
-                                            prompt_id = potential_id
-                                            print(f"[ImageWebSocketOutput] 从全局变量获取到prompt_id (变量: {var_name}): {prompt_id}")
-                                            break
-                                
-                                if prompt_id:
-                                    break
-                        except Exception as e:
-                            print(f"[ImageWebSocketOutput] 从调用栈获取prompt_id失败: {e}")
-                    
-                    # 准备HTTP消息
-                    http_message = {
-                        "type": "image_websocket_output",
-                        "react_node_id": react_node_id.strip(),
-                        "image_data": image_base64,
-                        "timestamp": int(time.time() * 1000),
-                        "image_index": i,
-                        "workflow_data": workflow_info,
-                        "prompt_id": prompt_id
-                    }
-                    
-                    if prompt_id:
-                        print(f"[ImageWebSocketOutput] 包含prompt_id: {prompt_id}")
-                    else:
-                        print(f"[ImageWebSocketOutput] 未能获取prompt_id")
-                    
-                    # 发送HTTP请求
-                    print(f"[ImageWebSocketOutput] 发送图像 {i+1}/{len(images)} 到节点 {react_node_id}")
-                    send_success = self.send_http_message(http_message, proxy_url)
-                    
-                    if send_success:
-                        success_count += 1
-                        success_msg = f"图像 {i+1} 发送成功"
-                        message_log.append(success_msg)
-                        print(f"[ImageWebSocketOutput] {success_msg}")
-                    else:
-                        error_msg = f"图像 {i+1} 发送失败: {self.last_error}"
-                        message_log.append(f"错误: {error_msg}")
-                        print(f"[ImageWebSocketOutput] {error_msg}")
-                    
-                except Exception as e:
-                    error_msg = f"处理图像 {i+1} 失败: {str(e)}"
-                    message_log.append(f"错误: {error_msg}")
-                    print(f"[ImageWebSocketOutput] {error_msg}")
-                    continue
+            # 工作流数据和prompt_id对整个批次相同，只获取一次
+            prompt_id = self.resolve_prompt_id()
+            workflow_info = self.resolve_workflow_info(workflow_data, prompt, extra_pnginfo, prompt_id)
+            if prompt_id:
+                print(f"[ImageWebSocketOutput] 包含prompt_id: {prompt_id}")
+            else:
+                print(f"[ImageWebSocketOutput] 未能获取prompt_id")
+            
+            # 编码图像（JSON传输时再编码为base64）
+            encoded_images, failed = self.encode_images(images, image_format, compress_level, quality)
+            for i in failed:
+                error_msg = f"图像 {i+1} 转换失败"
+                message_log.append(f"错误: {error_msg}")
+                print(f"[ImageWebSocketOutput] {error_msg}")
+            
+            shared_metadata = {
+                "react_node_id": react_node_id.strip(),
+                "workflow_data": workflow_info,
+                "prompt_id": prompt_id,
+                "comfy_node_id": unique_id,
+                "image_format": image_format,
+            }
+            
+            # 后台模式：放入发送队列后立即返回，不阻塞执行线程
+            if delivery == "background":
+                job = {
+                    "encoded_images": encoded_images,
+                    "shared_metadata": shared_metadata,
+                    "total_images": len(images),
+                    "proxy_url": proxy_url,
+                    "transport": transport,
+                    "send_mode": send_mode,
+                    "workflow_transfer": workflow_transfer,
+                }
+                queued = get_send_queue().submit(job, queue_policy)
+                queue_msg = f"{len(encoded_images)} 张图像已加入后台发送队列 ({queued})"
+                message_log.append(queue_msg)
+                print(f"[ImageWebSocketOutput] {queue_msg}")
+                return (images, "已加入发送队列", "\n".join(message_log))
+            
+            results = self.deliver(encoded_images, shared_metadata, len(images), proxy_url, transport, send_mode,
+                                   workflow_transfer)
+            success_count = self.log_results(results, message_log)
+            
+            # 输出连接池统计
+            pool_stats = get_http_session(proxy_url).stats()
+            print(f"[ImageWebSocketOutput] 连接池 {proxy_url}: 请求 {pool_stats['requests']}, "
+                  f"新建连接 {pool_stats['connections']}, 复用率 {pool_stats['reuse_rate']:.0%}, "
+                  f"平均延迟 {pool_stats['avg_latency_ms']:.1f} ms")
             
             # 返回结果
             if success_count > 0:
@@ -357,5 +1273,41 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "ImageWebSocketOutput": "Image WebSocket Output",
 }
 
+# 连接池统计API
+async def http_pool_stats_api(request):
+    from aiohttp import web
+    return web.json_response({"sessions": get_http_pool_stats()})
+
+# 后台发送状态API，可通过 ?prompt_id= 查询单个prompt
+async def send_status_api(request):
+    from aiohttp import web
+    prompt_id = request.query.get("prompt_id")
+    pending = _send_queue.pending() if _send_queue is not None else 0
+    return web.json_response({"pending_jobs": pending, "status": get_send_status(prompt_id)})
+
+# 工作流/prompt_id来源统计API
+async def discovery_stats_api(request):
+    from aiohttp import web
+    return web.json_response(get_discovery_stats())
+
+def register_api_routes():
+    try:
+        from server import PromptServer
+        if hasattr(PromptServer, 'instance') and PromptServer.instance:
+            PromptServer.instance.routes.get("/Base64Nodes/http_pool_stats")(http_pool_stats_api)
+            print("连接池统计API路由已注册: /Base64Nodes/http_pool_stats")
+            PromptServer.instance.routes.get("/Base64Nodes/send_status")(send_status_api)
+            print("发送状态API路由已注册: /Base64Nodes/send_status")
+            PromptServer.instance.routes.get("/Base64Nodes/discovery_stats")(discovery_stats_api)
+            print("来源统计API路由已注册: /Base64Nodes/discovery_stats")
+    except ImportError:
+        # 不在ComfyUI中运行（例如独立测试脚本）
+        pass
+    except Exception as e:
+        print(f"注册连接池统计API路由时出错: {str(e)}")
+
+register_api_routes()
+
 # 导出辅助函数供其他模块使用
-__all__ = ['ImageWebSocketOutput', 'set_current_workflow', 'get_current_workflow']
\ No newline at end of file
+__all__ = ['ImageWebSocketOutput', 'set_current_workflow', 'get_current_workflow', 'get_http_pool_stats', 'close_http_sessions',
+           'get_send_queue', 'flush_send_queue', 'get_send_status', 'get_discovery_stats']
\ No newline at end of file
@@ -0,0 +1,107 @@
+import asyncio
+import atexit
+import concurrent.futures
+import threading
+
+# run()等待协程结果的默认超时（秒）
+DEFAULT_TIMEOUT = 30
+
+
+class IORuntime:
+    """包内所有网络I/O共用的后台事件循环
+
+    WebSocket连接、HTTP会话等都在这个循环中创建和使用。节点代码运行在ComfyUI的
+    执行线程中，通过线程安全的submit()/run()提交协程，不再各自创建线程和事件循环。
+    shutdown()先执行注册的关闭回调（关闭连接、会话），再取消剩余任务并停止循环。
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self._shutdown_callbacks = []
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self._run_loop, name="Base64NodesIO", daemon=True)
+                self.thread.start()
+            return self.loop
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def in_loop_thread(self):
+        return self.thread is not None and threading.current_thread() is self.thread
+
+    def submit(self, coro):
+        """从任意线程提交协程，返回concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    def run(self, coro, timeout=DEFAULT_TIMEOUT):
+        """提交协程并等待结果；超时后取消协程并抛出TimeoutError
+
+        不能在事件循环线程中调用（会死锁），协程内部应直接await。
+        """
+        if self.in_loop_thread():
+            coro.close()
+            raise RuntimeError("IORuntime.run() 不能在I/O事件循环线程中调用")
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def on_shutdown(self, callback):
+        """注册关闭时执行的协程函数（无参数），按注册的逆序执行"""
+        self._shutdown_callbacks.append(callback)
+
+    async def _shutdown(self):
+        for callback in reversed(self._shutdown_callbacks):
+            try:
+                await callback()
+            except Exception as e:
+                print(f"[Base64Nodes] I/O关闭回调出错: {e}")
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def shutdown(self, timeout=10):
+        """关闭所有连接和会话并停止事件循环，之后再次提交会启动新的循环"""
+        with self._lock:
+            loop, thread = self.loop, self.thread
+            self.loop = None
+            self.thread = None
+        if loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), loop).result(timeout)
+        except Exception as e:
+            print(f"[Base64Nodes] 关闭I/O事件循环时出错: {e}")
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout)
+        if not thread.is_alive():
+            loop.close()
+
+
+_io_runtime = IORuntime()
+atexit.register(_io_runtime.shutdown)
+
+
+def get_io_runtime():
+    """获取进程级共享的I/O事件循环"""
+    return _io_runtime
+
+
+def submit(coro):
+    """在共享I/O事件循环中运行协程，返回concurrent.futures.Future"""
+    return _io_runtime.submit(coro)
+
+
+def run(coro, timeout=DEFAULT_TIMEOUT):
+    """在共享I/O事件循环中运行协程并等待结果"""
+    return _io_runtime.run(coro, timeout)
@@ -1,194 +1,100 @@
 import websockets
 import asyncio
+import concurrent.futures
 import json
 import base64
-from PIL import Image
-import io
+import os
+import threading
+from PIL import Image, ImageOps
 import numpy as np
 import torch
 import time
-import threading
+from collections import namedtuple
 from datetime import datetime
 
-# 全局状态存储，确保在ComfyUI的节点实例化过程中数据不丢失
-_global_state = {
-    'websocket': None,
-    'server_url': "ws://localhost:3079",
-    'connection_status': "🔴 未连接",
-    'current_image': None,
-    'current_element_name': "无",
-    'last_message_time': None,
-    'message_log': [],
-    'is_connecting': False,
-    'connection_thread': None,
-    'current_base64_data': "",
-    'initialized': False,
-    # 新增缓存机制
-    'cached_image': None,
-    'cached_element_name': "无",
-    'cached_base64_data': "",
-    'cache_updated': False,
-    'cache_timestamp': None
-}
+try:
+    from .base64_decode import alpha_to_mask, array_to_tensor, decode_image, open_image
+except ImportError:
+    from base64_decode import alpha_to_mask, array_to_tensor, decode_image, open_image
 
-class LeaferElementReceiver:
-    def __init__(self):
-        # 使用全局状态而不是实例状态
-        global _global_state
-        
-        # 只在第一次初始化时启动连接
-        if not _global_state['initialized']:
-            _global_state['initialized'] = True
-            self.start_connection()
-    
-    @property
-    def websocket(self):
-        return _global_state['websocket']
-    
-    @websocket.setter
-    def websocket(self, value):
-        _global_state['websocket'] = value
-    
-    @property
-    def server_url(self):
-        return _global_state['server_url']
-    
-    @server_url.setter
-    def server_url(self, value):
-        _global_state['server_url'] = value
-    
-    @property
-    def connection_status(self):
-        return _global_state['connection_status']
-    
-    @connection_status.setter
-    def connection_status(self, value):
-        _global_state['connection_status'] = value
-    
-    @property
-    def current_image(self):
-        return _global_state['current_image']
-    
-    @current_image.setter
-    def current_image(self, value):
-        _global_state['current_image'] = value
-    
-    @property
-    def current_element_name(self):
-        return _global_state['current_element_name']
-    
-    @current_element_name.setter
-    def current_element_name(self, value):
-        _global_state['current_element_name'] = value
-    
-    @property
-    def last_message_time(self):
-        return _global_state['last_message_time']
-    
-    @last_message_time.setter
-    def last_message_time(self, value):
-        _global_state['last_message_time'] = value
-    
-    @property
-    def message_log(self):
-        return _global_state['message_log']
-    
-    @message_log.setter
-    def message_log(self, value):
-        _global_state['message_log'] = value
-    
-    @property
-    def is_connecting(self):
-        return _global_state['is_connecting']
-    
-    @is_connecting.setter
-    def is_connecting(self, value):
-        _global_state['is_connecting'] = value
-    
-    @property
-    def connection_thread(self):
-        return _global_state['connection_thread']
-    
-    @connection_thread.setter
-    def connection_thread(self, value):
-        _global_state['connection_thread'] = value
-    
-    @property
-    def current_base64_data(self):
-        return _global_state['current_base64_data']
-    
-    @current_base64_data.setter
-    def current_base64_data(self, value):
-        _global_state['current_base64_data'] = value
-    
-    # 缓存相关属性
-    @property
-    def cached_image(self):
-        return _global_state['cached_image']
-    
-    @cached_image.setter
-    def cached_image(self, value):
-        _global_state['cached_image'] = value
-    
-    @property
-    def cached_element_name(self):
-        return _global_state['cached_element_name']
-    
-    @cached_element_name.setter
-    def cached_element_name(self, value):
-        _global_state['cached_element_name'] = value
-    
-    @property
-    def cached_base64_data(self):
-        return _global_state['cached_base64_data']
-    
-    @cached_base64_data.setter
-    def cached_base64_data(self, value):
-        _global_state['cached_base64_data'] = value
-    
-    @property
-    def cache_updated(self):
-        return _global_state['cache_updated']
-    
-    @cache_updated.setter
-    def cache_updated(self, value):
-        _global_state['cache_updated'] = value
-    
-    @property
-    def cache_timestamp(self):
-        return _global_state['cache_timestamp']
-    
-    @cache_timestamp.setter
-    def cache_timestamp(self, value):
-        _global_state['cache_timestamp'] = value
+try:
+    from .decode_cache import get_decode_cache, payload_fingerprint
+except ImportError:
+    from decode_cache import get_decode_cache, payload_fingerprint
+
+try:
+    from .io_runtime import get_io_runtime
+except ImportError:
+    from io_runtime import get_io_runtime
+
+# 与Leafer服务器的消息协议
+#
+# 握手时客户端发送 {"type": "comfy_node_client", "capabilities": {"binary_images": true}}。
+# 不支持二进制帧的旧服务器会忽略capabilities，继续在JSON文本帧的 "image" 字段中发送
+# base64 data URL。支持的服务器可以改为先发送一个不含 "image" 的小JSON头帧:
+#   {"type": "element_selected", "elementName": "...", "binary": true,
+#    "mimeType": "image/png", "byteLength": 12345}
+# 紧接着发送一个二进制帧，内容为原始的PNG/WebP等图像字节。
+# 这样省去base64膨胀、对大字符串的json.loads以及一份完整拷贝。
+
+# refresh时等待服务器返回当前元素的最长时间（秒），包含断线后重新连接的时间
+REFRESH_TIMEOUT = float(os.environ.get("LEAFER_REFRESH_TIMEOUT", "5"))
+# 连接断开后自动重连的间隔（秒）
+RECONNECT_DELAY = 5
+# 单条消息（文本帧或二进制图像帧）的大小上限（MB），0表示不限制；
+# websockets默认只允许1MB，多MB的PNG/WebP选中元素会导致连接以1009关闭
+MAX_MESSAGE_MB = float(os.environ.get("LEAFER_MAX_MESSAGE_MB", "0"))
+# 接收节点超过该时间（秒）未执行即视为已从工作流中删除，不再为其保留连接
+NODE_TTL = float(os.environ.get("LEAFER_NODE_TTL", "3600"))
+
+
+class ElementSnapshot(namedtuple("ElementSnapshot", ["version", "element_name", "payload", "mime_type", "payload_hash", "timestamp"])):
+    """某一时刻选中元素的不可变快照
+
+    payload为base64字符串或二进制帧的原始图像字节，未选中时为空字符串、payload_hash为None。
+    version在内容（元素名或payload指纹）变化时递增，接收线程整体替换快照引用，
+    执行线程只读取一次引用，因此总能看到同一时刻的元素名、payload和时间戳。
+    """
+    __slots__ = ()
     
     @property
-    def initialized(self):
-        return _global_state['initialized']
-    
-    @initialized.setter
-    def initialized(self, value):
-        _global_state['initialized'] = value
-    
-    @classmethod
-    def INPUT_TYPES(cls):
-        return {
-            "required": {
-                "server_url": ("STRING", {"default": "ws://localhost:3079"}),
-                "refresh": ("BOOLEAN", {"default": False}),
-                "output_base64": ("BOOLEAN", {"default": False}),
-                "force_update": ("INT", {"default": 0, "min": 0, "max": 999999}),
-            },
-        }
-    
-    RETURN_TYPES = ("IMAGE", "STRING", "STRING", "STRING", "STRING")
-    RETURN_NAMES = ("element_image", "element_name", "connection_status", "message_log", "base64_data")
-    FUNCTION = "receive_element"
-    CATEGORY = "ETN"
-    DISPLAY_NAME = "Leafer Element Receiver"
-    
-    # 添加输出缓存控制，确保每次都重新执行
-    OUTPUT_NODE = False
+    def payload_size(self):
+        return len(self.payload) if self.payload else 0
+    
+    def base64_output(self):
+        """base64_data输出；二进制帧收到的图像按需编码为data URL"""
+        if isinstance(self.payload, (bytes, bytearray)):
+            encoded = base64.b64encode(self.payload).decode('ascii')
+            return f"data:{self.mime_type};base64,{encoded}"
+        return self.payload
+
+
+EMPTY_SNAPSHOT = ElementSnapshot(0, "无", "", "image/png", None, None)
+
+
+class LeaferConnection:
+    """与一个Leafer服务器的WebSocket连接，以及该服务器当前选中的元素
+
+    连接在共享I/O事件循环中运行并自动重连。连接同一URL的所有接收节点共享
+    收到的payload和解码结果；网络相关的成员只在I/O事件循环线程中访问。
+    """
+    
+    def __init__(self, server_url):
+        self.server_url = server_url
+        self.websocket = None
+        self.task = None
+        self.connection_status = "🔴 未连接"
+        self.last_message_time = None
+        self.message_log = []
+        # 当前元素的快照，只由I/O事件循环线程通过一次引用赋值整体替换
+        self.snapshot = EMPTY_SNAPSHOT
+        # 延迟解码的结果 (payload指纹, 图像)、(payload指纹, alpha蒙版)，同样整体替换
+        self.decoded_image = None
+        self.cached_alpha_mask = None
+        # 等待配对的二进制头帧、连接建立事件、等待当前元素响应的future
+        self.pending_binary_header = None
+        self.connected_event = asyncio.Event()
+        self.pending_requests = []
     
     def add_log(self, message):
         """添加日志消息"""
@@ -200,60 +106,63 @@ class LeaferElementReceiver:
         if len(self.message_log) > 20:
             self.message_log = self.message_log[-20:]
         
-        print(f"[LeaferReceiver] {log_entry}")
+        print(f"[LeaferReceiver] [{self.server_url}] {log_entry}")
     
-    def start_connection(self):
-        """启动WebSocket连接"""
-        if self.is_connecting:
-            return
-            
-        self.is_connecting = True
-        self.connection_thread = threading.Thread(target=self.connect_websocket, daemon=True)
-        self.connection_thread.start()
+    def start(self):
+        """在共享I/O事件循环中启动连接任务（已在运行时不做任何事）"""
+        if self.task is None or self.task.done():
+            self.task = get_io_runtime().submit(self.connect_websocket())
     
-    def connect_websocket(self):
-        """连接WebSocket服务器"""
+    async def connect_websocket(self):
+        """连接WebSocket服务器（在共享I/O事件循环中运行）"""
         try:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            loop.run_until_complete(self.websocket_handler())
+            await self.websocket_handler()
+        except asyncio.CancelledError:
+            # 连接被释放或I/O事件循环关闭
+            raise
         except Exception as e:
             self.connection_status = f"🔴 连接错误: {str(e)}"
             self.add_log(f"连接错误: {str(e)}")
-        finally:
-            self.is_connecting = False
     
     async def websocket_handler(self):
         """WebSocket连接处理器"""
         while True:
             try:
                 self.add_log(f"正在连接到 {self.server_url}...")
-                async with websockets.connect(self.server_url) as websocket:
+                max_size = int(MAX_MESSAGE_MB * 1024 * 1024) or None
+                async with websockets.connect(self.server_url, max_size=max_size) as websocket:
                     self.websocket = websocket
                     self.connection_status = "🟢 已连接"
                     self.add_log("WebSocket连接成功")
                     
-                    # 发送客户端标识
+                    # 发送客户端标识，并声明支持二进制图像帧
+                    self.pending_binary_header = None
                     await websocket.send(json.dumps({
-                        "type": "comfy_node_client"
+                        "type": "comfy_node_client",
+                        "capabilities": {"binary_images": True}
                     }))
                     self.add_log("已发送ComfyUI节点客户端标识")
+                    self.connected_event.set()
                     
-                    # 监听消息
+                    # 监听消息：文本帧为JSON消息，二进制帧为前一个头帧对应的图像字节
                     async for message in websocket:
-                        await self.handle_message(message)
+                        if isinstance(message, bytes):
+                            await self.handle_binary_message(message)
+                        else:
+                            await self.handle_message(message)
                         
             except websockets.exceptions.ConnectionClosed:
                 self.connection_status = "🔴 连接已断开"
                 self.add_log("WebSocket连接已断开")
-                self.websocket = None
             except Exception as e:
                 self.connection_status = f"🔴 连接错误: {str(e)}"
                 self.add_log(f"WebSocket连接错误: {str(e)}")
+            finally:
                 self.websocket = None
+                self.connected_event.clear()
             
-            # 等待5秒后重连
-            await asyncio.sleep(5)
+            # 等待后重连
+            await asyncio.sleep(RECONNECT_DELAY)
             self.add_log("尝试重新连接...")
     
     async def handle_message(self, message):
@@ -265,177 +174,30 @@ class LeaferElementReceiver:
             if message_type == 'system':
                 self.add_log(f"系统消息: {data.get('message', '')}")
             
+            elif message_type == 'protocol_ack':
+                self.add_log(f"服务器协议确认: 二进制图像帧 {'已启用' if data.get('binary_images') else '未启用'}")
+            
+            elif data.get('binary') and message_type in ('element_selected', 'current_element_response'):
+                # 图像字节在下一个二进制帧中
+                self.pending_binary_header = data
+            
             elif message_type == 'element_selected':
                 self.add_log(f"收到元素选中消息: {data.get('elementName', 'Unknown')}")
-                
-                # 更新元素信息
-                element_name = data.get('elementName', 'Unknown Element')
-                self.current_element_name = element_name
-                self.last_message_time = datetime.now()
-                
-                print(f"[LeaferReceiver] 收到元素选中事件: {element_name}")
-                print(f"[LeaferReceiver] 完整数据结构: {list(data.keys())}")
-                
-                # 处理图像数据
-                image_data = data.get('image')
-                processed_image = None
-                base64_data = ""
-                
-                if image_data:
-                    print(f"[LeaferReceiver] 图像数据存在，类型: {type(image_data)}")
-                    if isinstance(image_data, str):
-                        print(f"[LeaferReceiver] Base64数据长度: {len(image_data)}")
-                        print(f"[LeaferReceiver] Base64数据开头: {image_data[:100]}")
-                        
-                        # 检查是否是有效的Base64格式
-                        if image_data.startswith('data:'):
-                            print(f"[LeaferReceiver] 检测到data URL格式")
-                        elif len(image_data) > 100:
-                            print(f"[LeaferReceiver] 检测到纯Base64格式")
-                        else:
-                            print(f"[LeaferReceiver] 警告: Base64数据可能过短")
-                    
-                    self.add_log(f"收到图像数据，类型: {type(image_data)}, 长度: {len(image_data) if isinstance(image_data, str) else 'N/A'}")
-                    
-                    # 保存原始base64数据
-                    if isinstance(image_data, str):
-                        self.current_base64_data = image_data
-                        base64_data = image_data
-                        
-                        # 尝试处理图像
-                        try:
-                            print(f"[LeaferReceiver] 开始处理元素选中图像数据...")
-                            processed_image = self.process_image_data(image_data)
-                            if processed_image is not None:
-                                self.current_image = processed_image
-                                self.add_log(f"图像处理成功，tensor形状: {processed_image.shape}")
-                                print(f"[LeaferReceiver] 元素选中图像处理成功!")
-                            else:
-                                self.add_log("图像处理返回None，使用占位符")
-                                print(f"[LeaferReceiver] 图像处理返回None")
-                                processed_image = self.create_placeholder_image()
-                                self.current_image = processed_image
-                        except Exception as e:
-                            self.add_log(f"图像处理异常: {str(e)}")
-                            print(f"[LeaferReceiver] 图像处理详细错误: {e}")
-                            import traceback
-                            traceback.print_exc()
-                            processed_image = self.create_placeholder_image()
-                            self.current_image = processed_image
-                    else:
-                        self.add_log(f"错误: 图像数据类型无效: {type(image_data)}")
-                        print(f"[LeaferReceiver] 图像数据类型错误: {type(image_data)}")
-                        self.current_base64_data = ""
-                        self.current_image = self.create_placeholder_image()
-                        processed_image = self.create_placeholder_image()
-                else:
-                    self.add_log("消息中没有图像数据字段")
-                    print(f"[LeaferReceiver] 没有图像数据字段")
-                    self.current_base64_data = ""
-                    self.current_image = self.create_placeholder_image()
-                    processed_image = self.create_placeholder_image()
-                
-                # 立即更新缓存数据
-                self.cached_image = processed_image
-                self.cached_element_name = element_name
-                self.cached_base64_data = base64_data
-                self.cache_updated = True
-                self.cache_timestamp = time.time()
-                print(f"[LeaferReceiver] 缓存已更新(element_selected): {element_name}, 图像: {'有效' if processed_image is not None else '无效'}, Base64长度: {len(base64_data)}")
-                self.add_log(f"缓存已更新(element_selected): {element_name}")
+                self.store_element(data, 'element_selected')
+                self.resolve_pending_requests()
             
             elif message_type == 'element_unselected':
                 self.add_log("收到元素取消选中消息")
-                self.current_element_name = "无"
-                self.current_base64_data = ""
-                self.current_image = self.create_placeholder_image()
                 
-                # 清空缓存数据
-                self.cached_image = self.create_placeholder_image()
-                self.cached_element_name = "无"
-                self.cached_base64_data = ""
-                self.cache_updated = True
-                self.cache_timestamp = time.time()
+                # 清空缓存数据，占位图像在 receive_element 时生成
+                self.publish("无", "", "image/png", None)
                 self.add_log("缓存已清空(element_unselected)")
+                self.resolve_pending_requests()
             
             elif message_type == 'current_element_response':
                 self.add_log(f"收到当前元素响应: {data.get('elementName', 'Unknown')}")
-                
-                # 更新元素信息
-                element_name = data.get('elementName', 'Unknown Element')
-                self.current_element_name = element_name
-                self.last_message_time = datetime.now()
-                
-                print(f"[LeaferReceiver] 收到当前元素响应: {element_name}")
-                print(f"[LeaferReceiver] 完整数据结构: {list(data.keys())}")
-                
-                # 处理图像数据
-                image_data = data.get('image')
-                processed_image = None
-                base64_data = ""
-                
-                if image_data:
-                    print(f"[LeaferReceiver] 当前元素图像数据存在，类型: {type(image_data)}")
-                    if isinstance(image_data, str):
-                        print(f"[LeaferReceiver] 当前元素Base64数据长度: {len(image_data)}")
-                        print(f"[LeaferReceiver] 当前元素Base64数据开头: {image_data[:100]}")
-                        
-                        # 检查是否是有效的Base64格式
-                        if image_data.startswith('data:'):
-                            print(f"[LeaferReceiver] 当前元素检测到data URL格式")
-                        elif len(image_data) > 100:
-                            print(f"[LeaferReceiver] 当前元素检测到纯Base64格式")
-                        else:
-                            print(f"[LeaferReceiver] 当前元素警告: Base64数据可能过短")
-                    
-                    self.add_log(f"收到当前元素图像数据，类型: {type(image_data)}, 长度: {len(image_data) if isinstance(image_data, str) else 'N/A'}")
-                    
-                    # 保存原始base64数据
-                    if isinstance(image_data, str):
-                        self.current_base64_data = image_data
-                        base64_data = image_data
-                        
-                        # 尝试处理图像
-                        try:
-                            print(f"[LeaferReceiver] 开始处理当前元素图像数据...")
-                            processed_image = self.process_image_data(image_data)
-                            if processed_image is not None:
-                                self.current_image = processed_image
-                                self.add_log(f"当前元素图像处理成功，tensor形状: {processed_image.shape}")
-                                print(f"[LeaferReceiver] 当前元素图像处理成功!")
-                            else:
-                                self.add_log("当前元素图像处理返回None，使用占位符")
-                                print(f"[LeaferReceiver] 当前元素图像处理返回None")
-                                processed_image = self.create_placeholder_image()
-                                self.current_image = processed_image
-                        except Exception as e:
-                            self.add_log(f"当前元素图像处理异常: {str(e)}")
-                            print(f"[LeaferReceiver] 当前元素图像处理详细错误: {e}")
-                            import traceback
-                            traceback.print_exc()
-                            processed_image = self.create_placeholder_image()
-                            self.current_image = processed_image
-                    else:
-                        self.add_log(f"错误: 当前元素图像数据类型无效: {type(image_data)}")
-                        print(f"[LeaferReceiver] 当前元素图像数据类型错误: {type(image_data)}")
-                        self.current_base64_data = ""
-                        self.current_image = self.create_placeholder_image()
-                        processed_image = self.create_placeholder_image()
-                else:
-                    self.add_log("当前元素响应中没有图像数据字段")
-                    print(f"[LeaferReceiver] 当前元素没有图像数据字段")
-                    self.current_base64_data = ""
-                    self.current_image = self.create_placeholder_image()
-                    processed_image = self.create_placeholder_image()
-                
-                # 立即更新缓存数据
-                self.cached_image = processed_image
-                self.cached_element_name = element_name
-                self.cached_base64_data = base64_data
-                self.cache_updated = True
-                self.cache_timestamp = time.time()
-                print(f"[LeaferReceiver] 缓存已更新(current_element_response): {element_name}, 图像: {'有效' if processed_image is not None else '无效'}, Base64长度: {len(base64_data)}")
-                self.add_log(f"缓存已更新(current_element_response): {element_name}")
+                self.store_element(data, 'current_element_response')
+                self.resolve_pending_requests()
             
             else:
                 self.add_log(f"收到未知消息类型: {message_type}")
@@ -443,113 +205,303 @@ class LeaferElementReceiver:
         except Exception as e:
             self.add_log(f"消息处理错误: {str(e)}")
     
+    async def handle_binary_message(self, frame):
+        """处理二进制图像帧，与之前收到的JSON头帧配对"""
+        header = self.pending_binary_header
+        self.pending_binary_header = None
+        if header is None:
+            self.add_log(f"收到没有头帧的二进制消息，已忽略 ({len(frame)} 字节)")
+            return
+        
+        expected = header.get('byteLength')
+        if expected is not None and expected != len(frame):
+            self.add_log(f"警告: 二进制帧长度 {len(frame)} 与头帧声明的 {expected} 不一致")
+        
+        message_type = header.get('type')
+        self.add_log(f"收到二进制图像帧({message_type}): {header.get('elementName', 'Unknown')}")
+        self.store_element(header, message_type, image_bytes=frame)
+        self.resolve_pending_requests()
+    
+    def store_element(self, data, source, image_bytes=None):
+        """记录选中元素的原始payload和内容指纹，不在websocket线程中解码
+
+        payload为JSON中的base64字符串，或二进制帧中的原始图像字节(image_bytes)。
+        用户快速切换元素时只有最后一次选中会被 receive_element 解码。
+        """
+        element_name = data.get('elementName', 'Unknown Element')
+        self.last_message_time = datetime.now()
+        
+        image_data = data.get('image')
+        mime_type = data.get('mimeType', 'image/png')
+        if image_bytes:
+            payload = image_bytes
+            payload_hash = payload_fingerprint(image_bytes)
+            self.add_log(f"收到二进制图像数据，长度: {len(image_bytes)}")
+        elif isinstance(image_data, str) and image_data:
+            payload = image_data
+            payload_hash = payload_fingerprint(image_data)
+            self.add_log(f"收到图像数据，长度: {len(image_data)}")
+        else:
+            if image_data:
+                self.add_log(f"错误: 图像数据类型无效: {type(image_data)}")
+            else:
+                self.add_log("消息中没有图像数据字段")
+            payload = ""
+            payload_hash = None
+        
+        # 立即发布新快照（图像延迟到 receive_element 时再解码）
+        snapshot = self.publish(element_name, payload, mime_type, payload_hash)
+        self.add_log(f"缓存已更新({source}): {element_name}, 数据长度: {snapshot.payload_size}, 版本: {snapshot.version}")
+    
+    def publish(self, element_name, payload, mime_type, payload_hash):
+        """发布当前元素的新快照并返回它；元素名和payload指纹都未变化时保留原快照
+
+        只在I/O事件循环线程中调用，因此版本号无需加锁即可单调递增。
+        """
+        current = self.snapshot
+        if current.element_name == element_name and current.payload_hash == payload_hash and current.version:
+            return current
+        snapshot = ElementSnapshot(current.version + 1, element_name, payload, mime_type, payload_hash, time.time())
+        self.snapshot = snapshot
+        return snapshot
+    
+    def resolve_pending_requests(self):
+        """收到元素状态（选中、取消选中或当前元素响应）后唤醒所有等待中的请求"""
+        pending = self.pending_requests
+        while pending:
+            future = pending.pop()
+            if not future.done():
+                future.set_result(True)
+    
+    async def request_current_element(self, timeout=REFRESH_TIMEOUT):
+        """请求当前选中的元素并等待服务器响应（在I/O事件循环中运行）
+
+        未连接时先等待连接建立，整个过程不超过timeout秒。收到响应返回True，
+        未连接、发送失败或超时返回False，此时缓存保持原样。
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            await asyncio.wait_for(self.connected_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.add_log("WebSocket未连接，无法发送请求")
+            return False
+        
+        future = loop.create_future()
+        self.pending_requests.append(future)
+        try:
+            await self.websocket.send(json.dumps({
+                "type": "request_current_element",
+                "timestamp": int(time.time() * 1000)
+            }))
+            self.add_log("已发送当前元素请求")
+            await asyncio.wait_for(future, max(deadline - loop.time(), 0))
+            return True
+        except asyncio.TimeoutError:
+            self.add_log(f"等待当前元素响应超时({timeout}秒)")
+            return False
+        except Exception as e:
+            self.add_log(f"发送当前元素请求失败: {str(e)}")
+            return False
+        finally:
+            if future in self.pending_requests:
+                self.pending_requests.remove(future)
+    
+    async def close(self):
+        """停止重连并关闭连接（在I/O事件循环中运行）"""
+        task = self.task
+        self.task = None
+        if task is not None:
+            task.cancel()
+        websocket = self.websocket
+        if websocket is not None:
+            await websocket.close()
+        self.connection_status = "🔴 未连接"
+        self.add_log("连接已关闭")
+    
+    def call_in_loop(self, coro, timeout):
+        """从执行线程调用I/O事件循环中的协程并等待结果，超时返回None"""
+        try:
+            return get_io_runtime().run(coro, timeout)
+        except concurrent.futures.TimeoutError:
+            self.add_log(f"I/O事件循环响应超时({timeout}秒)")
+            return None
+
+
+class LeaferConnectionPool:
+    """按server_url管理Leafer连接，并记录每个接收节点（unique_id）使用的URL
+
+    每个URL只有一个连接，所有连接复用共享I/O事件循环。节点按URL直接在字典中
+    找到自己的连接；节点改用其他URL、或超过NODE_TTL未执行（已被删除）后，
+    不再被任何节点使用的旧连接会被关闭。
+    """
+    
+    def __init__(self):
+        self.connections = {}
+        self.node_urls = {}
+        self.node_seen = {}
+        self._lock = threading.Lock()
+        get_io_runtime().on_shutdown(self.close_all)
+    
+    def peek(self, server_url):
+        """只读查询server_url现有连接的快照，不创建连接、不登记节点；没有连接时返回空快照"""
+        connection = self.connections.get(server_url)
+        return connection.snapshot if connection is not None else EMPTY_SNAPSHOT
+    
+    def acquire(self, server_url, node_id=None):
+        """返回server_url对应的连接（不存在则创建并启动），记录节点当前使用的URL"""
+        now = time.monotonic()
+        with self._lock:
+            # 可能不再被任何节点使用的URL
+            candidates = set()
+            url_changed = False
+            # node_id为None的调用方不登记，避免一个共享键把旧URL的连接一直保留
+            if node_id is not None:
+                previous_url = self.node_urls.get(node_id)
+                self.node_urls[node_id] = server_url
+                self.node_seen[node_id] = now
+                url_changed = previous_url is not None and previous_url != server_url
+                if url_changed:
+                    candidates.add(previous_url)
+            # 清理长时间未执行的节点
+            for expired in [node for node, seen in self.node_seen.items() if now - seen > NODE_TTL]:
+                candidates.add(self.node_urls.pop(expired))
+                del self.node_seen[expired]
+
+            connection = self.connections.get(server_url)
+            if connection is None:
+                connection = LeaferConnection(server_url)
+                self.connections[server_url] = connection
+            if url_changed:
+                connection.add_log(f"服务器URL已更新为: {server_url}")
+
+            in_use = set(self.node_urls.values())
+            in_use.add(server_url)
+            stale = [self.connections.pop(url) for url in candidates - in_use if url in self.connections]
+        for connection_to_close in stale:
+            get_io_runtime().submit(connection_to_close.close())
+        connection.start()
+        return connection
+    
+    def stats(self):
+        return [
+            {"server_url": url, "status": connection.connection_status,
+             "element_name": connection.snapshot.element_name,
+             "version": connection.snapshot.version,
+             "nodes": sum(1 for node_url in list(self.node_urls.values()) if node_url == url)}
+            for url, connection in list(self.connections.items())
+        ]
+    
+    async def close_all(self):
+        """关闭所有连接（在I/O事件循环关闭时自动调用）"""
+        for connection in list(self.connections.values()):
+            try:
+                await connection.close()
+            except Exception:
+                pass
+        self.connections.clear()
+        self.node_urls.clear()
+        self.node_seen.clear()
+
+
+_leafer_pool = LeaferConnectionPool()
+
+
+def get_leafer_pool():
+    """获取进程级共享的Leafer连接池"""
+    return _leafer_pool
+
+
+class LeaferElementReceiver:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "server_url": ("STRING", {"default": "ws://localhost:3079"}),
+                "refresh": ("BOOLEAN", {"default": False}),
+                "output_base64": ("BOOLEAN", {"default": False}),
+                "force_update": ("INT", {"default": 0, "min": 0, "max": 999999}),
+            },
+            "optional": {
+                "output_alpha_mask": ("BOOLEAN", {"default": False}),
+            },
+            "hidden": {
+                "unique_id": "UNIQUE_ID",
+            },
+        }
+    
+    RETURN_TYPES = ("IMAGE", "STRING", "STRING", "STRING", "STRING", "MASK")
+    RETURN_NAMES = ("element_image", "element_name", "connection_status", "message_log", "base64_data", "alpha_mask")
+    FUNCTION = "receive_element"
+    CATEGORY = "ETN"
+    DISPLAY_NAME = "Leafer Element Receiver"
+    
+    OUTPUT_NODE = False
+    
+    @classmethod
+    def IS_CHANGED(cls, server_url, refresh=False, output_base64=False, force_update=0, output_alpha_mask=False, unique_id=None, **kwargs):
+        """返回服务器当前元素的内容指纹，ComfyUI据此决定是否重新执行本节点及下游节点
+
+        只有选中元素的名称或图像内容变化时指纹才会变化，无需再手动修改force_update。
+        refresh=True时需要在执行中向服务器请求最新元素，因此总是重新执行。
+        """
+        if refresh:
+            return float("NaN")
+        # 只读取现有连接的快照，不在这里创建连接或登记节点；连接由节点执行时建立
+        snapshot = get_leafer_pool().peek(server_url)
+        return f"{snapshot.payload_hash}:{snapshot.element_name}"
+    
+    def materialize_cached_image(self, connection, snapshot):
+        """按需解码快照中的payload，同一payload只解码一次"""
+        payload_hash = snapshot.payload_hash
+        memo = connection.decoded_image
+        if memo is not None and memo[0] == payload_hash:
+            return memo[1]
+        
+        if payload_hash is None:
+            # 没有图像数据（未选中或数据无效）
+            processed_image = self.create_placeholder_image()
+        else:
+            print(f"[LeaferReceiver] 开始解码元素图像: {snapshot.element_name}")
+            processed_image = self.process_image_data(snapshot.payload)
+            if processed_image is not None:
+                connection.add_log(f"图像处理成功，tensor形状: {processed_image.shape}")
+            else:
+                connection.add_log("图像处理返回None，使用占位符")
+                processed_image = self.create_placeholder_image()
+        connection.decoded_image = (payload_hash, processed_image)
+        return processed_image
+    
     def process_image_data(self, image_data):
-        """处理Base64图像数据并转换为ComfyUI格式"""
+        """处理Base64图像数据并转换为ComfyUI格式 [1,H,W,3]，失败时返回None
+
+        解码缓存保存uint8像素，重复的payload只需归一化到缓冲池中的输出张量；
+        带透明度的图像在写入时合成到白色背景上。
+        """
+        image_array = get_decode_cache().get_or_decode("leafer", image_data, self._decode_image_data)
+        if image_array is None:
+            return None
+        return array_to_tensor(image_array)
+    
+    def process_alpha_mask(self, image_data):
+        """取出图像的alpha通道作为 [1,H,W] 蒙版（1为不透明），失败时返回None"""
+        image_array = get_decode_cache().get_or_decode("leafer", image_data, self._decode_image_data)
+        if image_array is None:
+            return None
+        return alpha_to_mask(image_array)
+    
+    def _decode_image_data(self, image_data):
+        """解码Base64图像数据为 [H,W,3] 或带alpha的 [H,W,4] uint8数组，失败时返回None"""
         try:
             print(f"[LeaferReceiver] 开始处理图像数据，原始长度: {len(image_data)}")
             
-            # 移除data URL前缀（支持多种格式）
-            prefixes = [
-                'data:image/png;base64,',
-                'data:image/jpeg;base64,',
-                'data:image/jpg;base64,',
-                'data:image/webp;base64,',
-                'data:image/gif;base64,',
-                'data:image/bmp;base64,',
-                'data:image/tiff;base64,',
-                'data:image/svg+xml;base64,',
-                'data:image/;base64,',
-                'data:;base64,'
-            ]
-            
-            base64_data = image_data
-            detected_prefix = None
-            for prefix in prefixes:
-                if image_data.startswith(prefix):
-                    base64_data = image_data[len(prefix):]
-                    detected_prefix = prefix
-                    break
-            
-            print(f"[LeaferReceiver] 检测到前缀: {detected_prefix}, Base64数据长度: {len(base64_data)}")
-            
-            # 验证和清理Base64数据
-            base64_data = base64_data.strip().replace('\n', '').replace('\r', '').replace(' ', '')
-            if not base64_data:
-                raise ValueError("Base64数据为空")
-            
-            print(f"[LeaferReceiver] 清理后Base64数据长度: {len(base64_data)}")
-            print(f"[LeaferReceiver] Base64数据前50字符: {base64_data[:50]}")
-            
-            # Base64填充修正
-            missing_padding = len(base64_data) % 4
-            if missing_padding:
-                base64_data += '=' * (4 - missing_padding)
-                print(f"[LeaferReceiver] 添加了 {4 - missing_padding} 个填充字符")
-            
-            # 验证Base64字符
-            import re
-            if not re.match(r'^[A-Za-z0-9+/]*={0,2}$', base64_data):
-                # 尝试替换URL安全的Base64字符
-                base64_data = base64_data.replace('-', '+').replace('_', '/')
-                if not re.match(r'^[A-Za-z0-9+/]*={0,2}$', base64_data):
-                    raise ValueError("包含无效的Base64字符")
-                print(f"[LeaferReceiver] 转换了URL安全Base64字符")
-            
-            # Base64解码
-            try:
-                image_bytes = base64.b64decode(base64_data, validate=True)
-                print(f"[LeaferReceiver] Base64解码成功，字节长度: {len(image_bytes)}")
-            except Exception as e:
-                print(f"[LeaferReceiver] Base64解码失败: {str(e)}")
-                # 尝试不验证的解码
-                try:
-                    image_bytes = base64.b64decode(base64_data, validate=False)
-                    print(f"[LeaferReceiver] 非验证Base64解码成功，字节长度: {len(image_bytes)}")
-                except Exception as e2:
-                    raise ValueError(f"Base64解码完全失败: validate=True({str(e)}), validate=False({str(e2)})")
-            
-            if len(image_bytes) < 50:
-                raise ValueError(f"解码后的图像数据过小: {len(image_bytes)} bytes")
-            
-            # 检查文件头
-            header = image_bytes[:20]
-            print(f"[LeaferReceiver] 文件头 (hex): {header.hex()}")
-            print(f"[LeaferReceiver] 文件头 (前10字节): {header[:10]}")
-            
-            # 多种方法尝试加载图像
-            image = None
-            
-            # 方法1: 直接使用PIL加载
-            try:
-                image = Image.open(io.BytesIO(image_bytes))
-                print(f"[LeaferReceiver] PIL直接加载成功: {image.format}, {image.mode}, {image.size}")
-            except Exception as e1:
-                print(f"[LeaferReceiver] PIL直接加载失败: {e1}")
-                
-                # 方法2: 检查文件头并强制格式
-                try:
-                    image = self._load_image_with_header_check(image_bytes)
-                    print(f"[LeaferReceiver] 文件头检查加载成功: {image.format}, {image.mode}, {image.size}")
-                except Exception as e2:
-                    print(f"[LeaferReceiver] 文件头检查加载失败: {e2}")
-                    
-                    # 方法3: 强制PNG格式加载
-                    try:
-                        image = self._load_image_force_format(image_bytes, 'PNG')
-                        print(f"[LeaferReceiver] 强制PNG加载成功: {image.mode}, {image.size}")
-                    except Exception as e3:
-                        print(f"[LeaferReceiver] 强制PNG加载失败: {e3}")
-                        
-                        # 方法4: 强制JPEG格式加载
-                        try:
-                            image = self._load_image_force_format(image_bytes, 'JPEG')
-                            print(f"[LeaferReceiver] 强制JPEG加载成功: {image.mode}, {image.size}")
-                        except Exception as e4:
-                            print(f"[LeaferReceiver] 强制JPEG加载失败: {e4}")
-                            raise ValueError(f"所有图像加载方法都失败: PIL({e1}), Header({e2}), PNG({e3}), JPEG({e4})")
-            
-            if image is None:
-                raise ValueError("图像加载返回None")
+            # 单次解码：去掉data URL前缀和空白、兼容URL安全字符，按文件头直接选择解码器，
+            # 无法识别的数据立即失败；二进制帧的图像字节直接交给解码器
+            if isinstance(image_data, (bytes, bytearray)):
+                image = open_image(memoryview(image_data), require_known_format=True)
+            else:
+                image = decode_image(image_data, require_known_format=True, urlsafe=True)
+            print(f"[LeaferReceiver] 图像加载成功: {image.format}, {image.mode}, {image.size}")
             
             # EXIF转换
             try:
@@ -563,23 +515,15 @@ class LeaferElementReceiver:
             original_mode = image.mode
             print(f"[LeaferReceiver] 原始图像模式: {original_mode}")
             
-            if image.mode == 'RGBA':
-                # 创建白色背景
-                background = Image.new('RGB', image.size, (255, 255, 255))
-                background.paste(image, mask=image.split()[-1])  # 使用alpha通道作为mask
-                image = background
-                print(f"[LeaferReceiver] RGBA转RGB完成")
+            if image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info):
+                # 保留alpha通道，输出时再用向量化运算合成到白色背景上
+                if image.mode != 'RGBA':
+                    image = image.convert('RGBA')
+                    print(f"[LeaferReceiver] {original_mode}转RGBA完成")
             elif image.mode == 'P':
                 # 调色板模式转换
-                if 'transparency' in image.info:
-                    image = image.convert('RGBA')
-                    background = Image.new('RGB', image.size, (255, 255, 255))
-                    background.paste(image, mask=image.split()[-1])
-                    image = background
-                    print(f"[LeaferReceiver] 透明调色板转RGB完成")
-                else:
-                    image = image.convert('RGB')
-                    print(f"[LeaferReceiver] 调色板转RGB完成")
+                image = image.convert('RGB')
+                print(f"[LeaferReceiver] 调色板转RGB完成")
             elif image.mode == 'L':
                 # 灰度转RGB
                 image = image.convert('RGB')
@@ -605,8 +549,8 @@ class LeaferElementReceiver:
             
             print(f"[LeaferReceiver] 最终图像: {image.mode}, {image.size}")
             
-            # 转换为numpy数组
-            image_array = np.array(image, dtype=np.float32) / 255.0
+            # 转换为uint8 numpy数组，归一化推迟到写入输出张量时进行
+            image_array = np.asarray(image)
             print(f"[LeaferReceiver] numpy数组形状: {image_array.shape}, 数据类型: {image_array.dtype}")
             
             # 转换为ComfyUI格式的tensor [B,H,W,C]
@@ -619,16 +563,9 @@ class LeaferElementReceiver:
                 # 单通道图像转为三通道
                 image_array = np.repeat(image_array, 3, axis=-1)
                 print(f"[LeaferReceiver] 单通道图像扩展为3通道")
-            elif len(image_array.shape) == 3 and image_array.shape[2] == 4:
-                # RGBA转RGB（虽然前面已经处理过，但保险起见）
-                image_array = image_array[:, :, :3]
-                print(f"[LeaferReceiver] RGBA数组转RGB")
-            
-            # 添加batch维度 [1,H,W,C]
-            image_tensor = torch.from_numpy(image_array).unsqueeze(0)
             
-            print(f"[LeaferReceiver] 图像处理成功: {original_mode} -> RGB, 尺寸: {image.size}, tensor形状: {image_tensor.shape}")
-            return image_tensor
+            print(f"[LeaferReceiver] 图像处理成功: {original_mode} -> {image.mode}, 尺寸: {image.size}, 数组形状: {image_array.shape}")
+            return image_array
             
         except Exception as e:
             print(f"[LeaferReceiver] 图像处理失败: {str(e)}")
@@ -636,60 +573,6 @@ class LeaferElementReceiver:
             traceback.print_exc()
             return None
     
-    def _load_image_with_header_check(self, image_bytes):
-        """通过检查文件头来加载图像"""
-        # 检查常见的图像文件头
-        headers = {
-            b'\x89PNG\r\n\x1a\n': 'PNG',
-            b'\xff\xd8\xff': 'JPEG',
-            b'GIF87a': 'GIF',
-            b'GIF89a': 'GIF',
-            b'RIFF': 'WEBP',
-            b'BM': 'BMP'
-        }
-        
-        detected_format = None
-        for header, format_name in headers.items():
-            if image_bytes.startswith(header):
-                detected_format = format_name
-                break
-        
-        if detected_format:
-            print(f"[LeaferReceiver] 检测到图像格式: {detected_format}")
-        
-        return Image.open(io.BytesIO(image_bytes))
-    
-    def _load_image_force_format(self, image_bytes, force_format=None):
-        """强制指定格式加载图像"""
-        formats = [force_format] if force_format else ['PNG', 'JPEG', 'WEBP', 'GIF', 'BMP']
-        
-        for fmt in formats:
-            try:
-                # 创建BytesIO对象
-                img_io = io.BytesIO(image_bytes)
-                
-                # 尝试直接加载
-                img = Image.open(img_io)
-                
-                # 如果指定了格式，尝试验证
-                if force_format:
-                    # 强制设置格式并尝试加载
-                    img.format = fmt
-                    img.load()  # 强制加载以验证格式
-                    print(f"[LeaferReceiver] 强制格式 {fmt} 加载成功")
-                    return img
-                else:
-                    # 尝试加载并验证
-                    img.load()
-                    print(f"[LeaferReceiver] 格式 {fmt} 加载成功")
-                    return img
-                    
-            except Exception as e:
-                print(f"[LeaferReceiver] 格式 {fmt} 加载失败: {e}")
-                continue
-        
-        raise ValueError(f"无法以格式 {force_format or '任何已知格式'} 加载图像")
-    
     def create_placeholder_image(self):
         """创建占位符图像"""
         # 创建一个灰色占位符图像，格式为 [B,H,W,C]
@@ -698,62 +581,63 @@ class LeaferElementReceiver:
         print(f"[LeaferReceiver] 创建占位符图像，形状: {placeholder.shape}")
         return placeholder
     
-    async def request_current_element(self):
-        """请求当前选中的元素"""
-        if self.websocket and self.websocket.open:
-            try:
-                await self.websocket.send(json.dumps({
-                    "type": "request_current_element",
-                    "timestamp": int(time.time() * 1000)
-                }))
-                self.add_log("已发送当前元素请求")
-            except Exception as e:
-                self.add_log(f"发送当前元素请求失败: {str(e)}")
-        else:
-            self.add_log("WebSocket未连接，无法发送请求")
-    
-    def receive_element(self, server_url, refresh, output_base64, force_update):
-        """接收元素的主要函数"""
-        # 如果服务器URL发生变化，更新并重新连接
-        if server_url != self.server_url:
-            self.server_url = server_url
-            self.add_log(f"服务器URL已更新为: {server_url}")
-            if self.websocket:
-                asyncio.create_task(self.websocket.close())
+    def materialize_alpha_mask(self, connection, snapshot):
+        """按需生成快照中元素的alpha蒙版，同一payload只生成一次"""
+        payload_hash = snapshot.payload_hash
+        memo = connection.cached_alpha_mask
+        if memo is not None and memo[0] == payload_hash:
+            return memo[1]
+        
+        alpha_mask = None
+        if payload_hash is not None:
+            alpha_mask = self.process_alpha_mask(snapshot.payload)
+        if alpha_mask is None:
+            # 没有图像时与占位图像同尺寸的全不透明蒙版
+            alpha_mask = torch.ones((1, 256, 256), dtype=torch.float32)
+        connection.cached_alpha_mask = (payload_hash, alpha_mask)
+        return alpha_mask
+    
+    def receive_element(self, server_url, refresh, output_base64, force_update, output_alpha_mask=False, unique_id=None):
+        """接收元素的主要函数：读取server_url对应连接的最新元素"""
+        connection = get_leafer_pool().acquire(server_url, unique_id)
         
-        # 如果刷新被触发，请求当前元素
+        # 如果刷新被触发，同步请求当前元素，最多等待REFRESH_TIMEOUT秒
         if refresh:
-            asyncio.create_task(self.request_current_element())
+            connection.call_in_loop(connection.request_current_element(REFRESH_TIMEOUT), REFRESH_TIMEOUT + 1)
         
-        # 使用缓存的数据而不是当前状态数据
-        image_output = self.cached_image if self.cached_image is not None else self.create_placeholder_image()
-        element_name = self.cached_element_name
-        base64_output = self.cached_base64_data if output_base64 else ""
+        # 只读取一次快照引用，之后的所有输出都来自同一时刻的元素
+        snapshot = connection.snapshot
+        image_output = self.materialize_cached_image(connection, snapshot)
+        element_name = snapshot.element_name
+        base64_output = snapshot.base64_output() if output_base64 else ""
+        mask_output = self.materialize_alpha_mask(connection, snapshot) if output_alpha_mask else torch.zeros((1, 64, 64), dtype=torch.float32)
         
         # 生成日志文本
-        log_text = "\n".join(self.message_log[-10:])  # 显示最近10条日志
+        log_text = "\n".join(connection.message_log[-10:])  # 显示最近10条日志
         
         # 调试信息
-        cache_status = "有缓存" if self.cache_updated else "无缓存"
-        cache_time = f", 缓存时间: {time.strftime('%H:%M:%S', time.localtime(self.cache_timestamp))}" if self.cache_timestamp else ""
+        cache_status = f"版本 {snapshot.version}" if snapshot.version else "无缓存"
+        cache_time = f", 缓存时间: {time.strftime('%H:%M:%S', time.localtime(snapshot.timestamp))}" if snapshot.timestamp else ""
         
         # 添加Base64输出状态提示
-        if len(self.cached_base64_data) > 0 and not output_base64:
-            self.add_log(f"⚠️ 警告: 有Base64数据({len(self.cached_base64_data)}字符)但output_base64未启用，请在节点设置中启用output_base64以获取完整Base64数据")
+        payload_size = snapshot.payload_size
+        if payload_size > 0 and not output_base64:
+            connection.add_log(f"⚠️ 警告: 有图像数据({payload_size}字节)但output_base64未启用，请在节点设置中启用output_base64以获取完整Base64数据")
         
-        self.add_log(f"输出状态 - 元素名: {element_name}, Base64长度: {len(self.cached_base64_data)}, 输出Base64: {output_base64}, 缓存状态: {cache_status}{cache_time}, 强制更新: {force_update}")
+        connection.add_log(f"输出状态 - 元素名: {element_name}, 数据长度: {payload_size}, 输出Base64: {output_base64}, 缓存状态: {cache_status}{cache_time}, 强制更新: {force_update}")
         
         # 确保返回的图像是有效的tensor
         if not isinstance(image_output, torch.Tensor):
-            self.add_log("警告: 缓存图像无效，使用占位符")
+            connection.add_log("警告: 缓存图像无效，使用占位符")
             image_output = self.create_placeholder_image()
         
         return (
             image_output,
             element_name,
-            self.connection_status,
+            connection.connection_status,
             log_text,
-            base64_output
+            base64_output,
+            mask_output
         )
 
 # 注册节点
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+本地代理替身，用于在没有React Flow代理的情况下测试ImageWebSocketOutput
+
+实现了节点会用到的全部HTTP接口：
+    POST /api/image-message        单张图像（JSON或multipart）
+    POST /api/image-batch-message  批量图像（JSON或multipart），返回每张图像的结果
+    POST /api/workflow-ref         上传工作流，之后的消息可只带workflow_ref
+    GET  /stats                    收到的请求数、字节数和已知的工作流引用
+    POST /reset                    清空已知的工作流引用（模拟代理重启）
+
+消息带有未知的workflow_ref时返回409，节点会重新上传工作流后重发。
+
+用法:
+    python mock_proxy_server.py [--port 3078] [--no-batch] [--no-multipart] [--no-workflow-ref]
+
+在脚本中使用:
+    from mock_proxy_server import start_mock_proxy
+    server, url = start_mock_proxy()
+    ImageWebSocketOutput().send_image(images, "node-1", url, workflow_transfer="reference")
+    print(server.stats())
+    server.shutdown()
+"""
+
+import argparse
+import json
+import threading
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def parse_multipart(content_type, body):
+    """把multipart/form-data请求体解析为 {字段名: 字节}"""
+    message = BytesParser(policy=HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode("latin-1") + body
+    )
+    return {
+        part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+        for part in message.iter_parts()
+    }
+
+
+class MockProxyHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1才会保持keep-alive连接，便于观察节点的连接复用
+    protocol_version = "HTTP/1.1"
+    # 响应头和正文合并写出，避免小包与延迟确认叠加造成约40ms的额外延迟
+    wbufsize = 64 * 1024
+
+    def _reply(self, status, payload=None):
+        body = json.dumps(payload if payload is not None else {}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_message(self, body):
+        """返回 (元数据, {字段名: 图像字节})；不支持的格式返回 (None, None)"""
+        content_type = self.headers.get("Content-Type", "")
+
+        if content_type.startswith("multipart/form-data"):
+            if not self.server.accept_multipart:
+                return None, None
+            fields = parse_multipart(content_type, body)
+            metadata = json.loads(fields.pop("metadata"))
+            return metadata, fields
+        return json.loads(body), {}
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._reply(200, self.server.stats())
+        else:
+            self._reply(404, {"error": "not_found"})
+
+    def do_POST(self):
+        # 无论是否处理都先读完请求体，保证keep-alive连接可以继续使用
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        self.server.record(self.path, length)
+
+        if self.path == "/reset":
+            self.server.reset()
+            self._reply(200, {"ok": True})
+            return
+
+        if self.path == "/api/workflow-ref":
+            if not self.server.accept_workflow_ref:
+                self._reply(404, {"error": "not_found"})
+                return
+            message, _ = self._read_message(body)
+            self.server.store_workflow(message["workflow_ref"], message.get("workflow_data"))
+            self._reply(200, {"ok": True})
+            return
+
+        if self.path == "/api/image-batch-message" and not self.server.accept_batch:
+            self._reply(404, {"error": "not_found"})
+            return
+        if self.path not in ("/api/image-message", "/api/image-batch-message"):
+            self._reply(404, {"error": "not_found"})
+            return
+
+        message, files = self._read_message(body)
+        if message is None:
+            self._reply(415, {"error": "unsupported_media_type"})
+            return
+
+        workflow_ref = message.get("workflow_ref")
+        if workflow_ref and not self.server.has_workflow(workflow_ref):
+            self._reply(409, {"error": "unknown_workflow_ref", "workflow_ref": workflow_ref})
+            return
+
+        if self.path == "/api/image-batch-message":
+            results = []
+            for image in message.get("images", []):
+                has_data = image.get("image_data") or files.get(image.get("field"))
+                results.append({
+                    "image_index": image["image_index"],
+                    "success": bool(has_data),
+                    "error": "" if has_data else "missing image data",
+                })
+            self.server.count_images(len(results))
+            self._reply(200, {"ok": True, "results": results})
+        else:
+            self.server.count_images(1)
+            self._reply(200, {"ok": True})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class MockProxyServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, accept_batch=True, accept_multipart=True, accept_workflow_ref=True, verbose=False):
+        super().__init__(address, MockProxyHandler)
+        self.accept_batch = accept_batch
+        self.accept_multipart = accept_multipart
+        self.accept_workflow_ref = accept_workflow_ref
+        self.verbose = verbose
+        self._lock = threading.Lock()
+        self._workflows = {}
+        self._requests = {}
+        self._bytes = 0
+        self._images = 0
+
+    def record(self, path, length):
+        with self._lock:
+            self._requests[path] = self._requests.get(path, 0) + 1
+            self._bytes += length
+
+    def count_images(self, count):
+        with self._lock:
+            self._images += count
+
+    def store_workflow(self, workflow_ref, workflow_data):
+        with self._lock:
+            self._workflows[workflow_ref] = workflow_data
+
+    def has_workflow(self, workflow_ref):
+        with self._lock:
+            return workflow_ref in self._workflows
+
+    def reset(self):
+        with self._lock:
+            self._workflows.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": dict(self._requests),
+                "bytes_received": self._bytes,
+                "images_received": self._images,
+                "workflow_refs": list(self._workflows),
+            }
+
+
+def start_mock_proxy(port=0, **options):
+    """在后台线程启动代理替身，返回 (server, 基础URL)；port为0时自动选择空闲端口"""
+    server = MockProxyServer(("127.0.0.1", port), **options)
+    threading.Thread(target=server.serve_forever, name="MockProxy", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ImageWebSocketOutput本地代理替身")
+    parser.add_argument("--port", type=int, default=3078)
+    parser.add_argument("--no-batch", action="store_true", help="模拟不支持批量消息的旧代理")
+    parser.add_argument("--no-multipart", action="store_true", help="模拟不支持multipart的旧代理")
+    parser.add_argument("--no-workflow-ref", action="store_true", help="模拟不支持工作流引用的旧代理")
+    args = parser.parse_args()
+
+    server = MockProxyServer(
+        ("127.0.0.1", args.port),
+        accept_batch=not args.no_batch,
+        accept_multipart=not args.no_multipart,
+        accept_workflow_ref=not args.no_workflow_ref,
+        verbose=True,
+    )
+    print(f"代理替身已启动: http://127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.stats(), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import os
+import threading
+import weakref
+
+import torch
+
+# 缓冲池上限（MB），设为0则禁用缓冲池；只有CPU的主机默认禁用
+DEFAULT_MAX_MB = int(os.environ.get("BASE64_TENSOR_POOL_MB", "512" if torch.cuda.is_available() else "0"))
+# 设为1时在有CUDA的主机上为池中缓冲区使用锁页内存（默认关闭）
+PIN_MEMORY = os.environ.get("BASE64_PINNED_MEMORY", "0") == "1"
+
+
+def _storage_shared(storage):
+    """存储是否还被池以外的对象（视图、numpy数组等）引用
+
+    池只持有一个存储对象，引用计数大于1即说明仍有外部使用者；
+    无法获取计数时保守地认为仍在使用，不复用。
+    """
+    use_count = getattr(torch._C, "_storage_Use_Count", None)
+    if use_count is None:
+        return True
+    return use_count(storage._cdata) > 1
+
+
+class _PooledBuffer:
+    """池中的一块存储；handed_out在交出的张量被回收后由finalizer清除"""
+
+    def __init__(self, storage, nbytes):
+        self.storage = storage
+        self.nbytes = nbytes
+        self.handed_out = False
+        self.last_used = 0
+
+    def is_idle(self):
+        return not self.handed_out and not _storage_shared(self.storage)
+
+    def release(self):
+        # finalizer可能在任意线程（包括持有池锁的线程中触发的GC）中运行，因此不加锁
+        self.handed_out = False
+
+
+class TensorPool:
+    """按 (形状, dtype) 复用输出张量的缓冲池
+
+    池只保存底层存储，每次交出的是一个新的张量对象。该张量被回收（ComfyUI缓存
+    不再持有它，也没有视图）且存储没有其他引用（如numpy数组）后，存储才会被再次
+    使用，因此ComfyUI缓存中的输出不会被覆盖。
+
+    新规格放不下时按最近最少使用的顺序释放空闲缓冲区，旧任务留下的规格不会一直占用上限。
+    锁页内存需显式启用。存储回到池中后可能立即被下一次输出覆盖，所以从池中张量
+    发起的 .to(device, non_blocking=True) 必须在丢弃CPU张量之前同步。
+    """
+
+    def __init__(self, max_bytes, pin_memory):
+        self.max_bytes = max_bytes
+        self.pin_memory = pin_memory
+        self.current_bytes = 0
+        self.reuses = 0
+        self.allocations = 0
+        self.evictions = 0
+        self._uses = 0
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    def _hand_out(self, buffer, shape, dtype):
+        self._uses += 1
+        buffer.last_used = self._uses
+        buffer.handed_out = True
+        tensor = torch.empty(0, dtype=dtype).set_(buffer.storage, 0, shape)
+        weakref.finalize(tensor, buffer.release)
+        return tensor
+
+    def _evict(self, nbytes):
+        """释放最近最少使用的空闲缓冲区，直到能再放下nbytes或没有可释放的缓冲区"""
+        if self.current_bytes + nbytes <= self.max_bytes:
+            return
+        idle = [
+            (buffer.last_used, key, buffer)
+            for key, buffers in self._buffers.items() for buffer in buffers if buffer.is_idle()
+        ]
+        idle.sort(key=lambda item: item[0])
+        for _, key, buffer in idle:
+            if self.current_bytes + nbytes <= self.max_bytes:
+                break
+            buffers = self._buffers[key]
+            buffers.remove(buffer)
+            if not buffers:
+                del self._buffers[key]
+            self.current_bytes -= buffer.nbytes
+            self.evictions += 1
+
+    def acquire(self, shape, dtype=torch.float32):
+        """获取一个未初始化的张量，优先复用池中空闲的同规格缓冲区"""
+        shape = tuple(shape)
+        key = (shape, dtype)
+        with self._lock:
+            for buffer in self._buffers.get(key, ()):
+                if buffer.is_idle():
+                    self.reuses += 1
+                    return self._hand_out(buffer, shape, dtype)
+
+            self.allocations += 1
+            nbytes = torch.Size(shape).numel() * dtype.itemsize
+            self._evict(nbytes)
+            if self.current_bytes + nbytes > self.max_bytes:
+                # 超出上限的张量不进入池，也不使用锁页内存（cudaHostAlloc很慢）
+                return torch.empty(shape, dtype=dtype)
+
+            storage = torch.empty(shape, dtype=dtype, pin_memory=self.pin_memory).untyped_storage()
+            buffer = _PooledBuffer(storage, nbytes)
+            self._buffers.setdefault(key, []).append(buffer)
+            self.current_bytes += nbytes
+            return self._hand_out(buffer, shape, dtype)
+
+    def clear(self):
+        with self._lock:
+            self._buffers.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "buffers": sum(len(buffers) for buffers in self._buffers.values()),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "pinned": self.pin_memory,
+                "reuses": self.reuses,
+                "allocations": self.allocations,
+                "evictions": self.evictions,
+            }
+
+
+_tensor_pool = TensorPool(
+    DEFAULT_MAX_MB * 1024 * 1024,
+    pin_memory=PIN_MEMORY and torch.cuda.is_available(),
+)
+
+
+def get_tensor_pool():
+    """获取进程级共享的张量缓冲池"""
+    return _tensor_pool
+
+
+def empty_tensor(shape, dtype=torch.float32):
+    """分配输出张量：缓冲池启用时从池中获取，否则直接torch.empty"""
+    if _tensor_pool.max_bytes <= 0:
+        return torch.empty(shape, dtype=dtype)
+    return _tensor_pool.acquire(shape, dtype)
@@ -6,9 +6,126 @@ import io
 import json
 import websockets
 import asyncio
+import os
 import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+try:
+    from .io_runtime import get_io_runtime
+except ImportError:
+    from io_runtime import get_io_runtime
+
+# 等待单条消息发送完成的最长时间（秒），包括必要时的重连
+SEND_TIMEOUT = 30
+
+# 流水线深度：最多提前编码、以及最多同时在途发送的图像数
+PIPELINE_DEPTH = 4
+
+# 编码线程池；PIL在PNG压缩时释放GIL，编码可与发送及其他编码并行
+_encode_executor = None
+_encode_executor_lock = threading.Lock()
+
+def get_encode_executor():
+    global _encode_executor
+    with _encode_executor_lock:
+        if _encode_executor is None:
+            _encode_executor = ThreadPoolExecutor(
+                max_workers=min(PIPELINE_DEPTH, os.cpu_count() or 1),
+                thread_name_prefix="WebSocketImageEncode",
+            )
+        return _encode_executor
+
+class WebSocketConnection:
+    """一个websocket_url对应的持久连接，断开后在下次发送时自动重连"""
+    
+    def __init__(self, websocket_url):
+        self.websocket_url = websocket_url
+        self.websocket = None
+        self.connects = 0
+        self.messages = 0
+        # 在后台事件循环中创建，保证同一连接上的帧按提交顺序写出
+        self._lock = asyncio.Lock()
+    
+    async def _connect(self):
+        self.websocket = await websockets.connect(
+            self.websocket_url,
+            open_timeout=10,  # 连接超时10秒
+            close_timeout=5,  # 关闭超时5秒
+            ping_interval=20, # ping间隔20秒
+            ping_timeout=10,  # ping超时10秒
+            max_size=None,
+        )
+        self.connects += 1
+        print(f"[WebSocketImageSender] 已连接到 {self.websocket_url}")
+    
+    async def send(self, message):
+        async with self._lock:
+            for attempt in range(2):
+                if self.websocket is None:
+                    await self._connect()
+                try:
+                    await self.websocket.send(message)
+                    self.messages += 1
+                    return
+                except websockets.exceptions.ConnectionClosed:
+                    # 连接已被服务器关闭（例如服务器重启），重连后重试一次
+                    self.websocket = None
+                    if attempt:
+                        raise
+    
+    async def close(self):
+        if self.websocket is not None:
+            await self.websocket.close()
+            self.websocket = None
+
+class WebSocketPool:
+    """按websocket_url复用持久连接，连接由包内共享的I/O事件循环持有
+    
+    submit()可在任意线程调用，返回concurrent.futures.Future。
+    """
+    
+    def __init__(self):
+        self.connections = {}
+        get_io_runtime().on_shutdown(self.close_all)
+    
+    async def _send(self, websocket_url, message):
+        connection = self.connections.get(websocket_url)
+        if connection is None:
+            connection = WebSocketConnection(websocket_url)
+            self.connections[websocket_url] = connection
+        await connection.send(message)
+    
+    def submit(self, websocket_url, message):
+        """提交一条消息，返回在发送完成（或失败）时结束的Future"""
+        return get_io_runtime().submit(self._send(websocket_url, message))
+    
+    def stats(self):
+        return [
+            {"websocket_url": url, "connects": connection.connects, "messages": connection.messages,
+             "connected": connection.websocket is not None}
+            for url, connection in list(self.connections.items())
+        ]
+    
+    async def close_all(self):
+        """关闭所有连接（在I/O事件循环关闭时自动调用）"""
+        for connection in list(self.connections.values()):
+            try:
+                await connection.close()
+            except Exception:
+                pass
+        self.connections.clear()
+    
+    def close(self):
+        get_io_runtime().run(self.close_all(), timeout=10)
+
+_websocket_pool = WebSocketPool()
+
+def get_websocket_pool():
+    """获取进程级共享的WebSocket连接池"""
+    return _websocket_pool
+
 class WebSocketImageSender:
     """
     ComfyUI节点：通过WebSocket发送图像到 ws://localhost:3078/image-ws
@@ -33,9 +150,44 @@ class WebSocketImageSender:
     CATEGORY = "ETN/WebSocket"
     OUTPUT_NODE = True
     
+    def encode_image_message(self, image_tensor, index, total_images, source_name, metadata_dict):
+        """把一张图像转换为PNG并打包成JSON消息（在编码线程中执行）"""
+        # 转换张量为PIL图像
+        if len(image_tensor.shape) == 3:
+            # 单张图像 (H, W, C)
+            image_np = (image_tensor.cpu().numpy() * 255).astype(np.uint8)
+        else:
+            # 批次中的图像
+            image_np = (image_tensor[0].cpu().numpy() * 255).astype(np.uint8)
+        
+        pil_image = Image.fromarray(image_np)
+        
+        # 转换为base64
+        buffer = io.BytesIO()
+        pil_image.save(buffer, format='PNG')
+        image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+        
+        message = {
+            "type": "image_data",
+            "image": image_base64,
+            "timestamp": datetime.now().isoformat(),
+            "source": source_name,
+            "metadata": {
+                **metadata_dict,
+                "batch_index": index,
+                "total_images": total_images,
+                "image_size": f"{pil_image.width}x{pil_image.height}",
+                "format": "PNG"
+            }
+        }
+        return json.dumps(message)
+    
     def send_images_websocket(self, images, source_name="ComfyUI", metadata="{}", websocket_url="ws://localhost:3078/image-ws"):
         """
         通过WebSocket发送图像并透传原始图像
+        
+        编码与发送流水线化：编码线程最多提前PIPELINE_DEPTH张图像，已编码的消息按
+        batch_index顺序交给连接池发送，发送第i张的同时编码后续图像。
         """
         try:
             # 解析元数据
@@ -44,48 +196,44 @@ class WebSocketImageSender:
             except json.JSONDecodeError:
                 metadata_dict = {"raw_metadata": metadata}
             
-            # 处理图像批次
-            for i, image_tensor in enumerate(images):
-                # 转换张量为PIL图像
-                if len(image_tensor.shape) == 3:
-                    # 单张图像 (H, W, C)
-                    image_np = (image_tensor.cpu().numpy() * 255).astype(np.uint8)
-                else:
-                    # 批次中的图像
-                    image_np = (image_tensor[0].cpu().numpy() * 255).astype(np.uint8)
-                
-                pil_image = Image.fromarray(image_np)
-                
-                # 转换为base64
-                buffer = io.BytesIO()
-                pil_image.save(buffer, format='PNG')
-                image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-                
-                # 发送到WebSocket服务器
+            total_images = len(images)
+            executor = get_encode_executor()
+            pool = get_websocket_pool()
+            encoding = deque()
+            sending = deque()
+            next_index = 0
+            
+            def finish_send(index, future):
                 try:
-                    # 发送图像数据
-                    message = {
-                        "type": "image_data",
-                        "image": image_base64,
-                        "timestamp": datetime.now().isoformat(),
-                        "source": source_name,
-                        "metadata": {
-                            **metadata_dict,
-                            "batch_index": i,
-                            "total_images": len(images),
-                            "image_size": f"{pil_image.width}x{pil_image.height}",
-                            "format": "PNG"
-                        }
-                    }
-                    
-                    # 使用 websockets 库发送数据
-                    self._send_websocket_sync(websocket_url, json.dumps(message))
-                    
-                    print(f"[WebSocketImageSender] 图像 {i+1}/{len(images)} 发送成功到 {websocket_url}")
-                        
+                    future.result(timeout=SEND_TIMEOUT)
+                    print(f"[WebSocketImageSender] 图像 {index+1}/{total_images} 发送成功到 {websocket_url}")
                 except Exception as e:
                     print(f"[WebSocketImageSender] WebSocket发送错误: {e}")
             
+            for index in range(total_images):
+                # 保持编码队列填满，编码与发送重叠
+                while next_index < total_images and len(encoding) < PIPELINE_DEPTH:
+                    encoding.append((next_index, executor.submit(
+                        self.encode_image_message, images[next_index], next_index, total_images,
+                        source_name, metadata_dict,
+                    )))
+                    next_index += 1
+                
+                _, encode_future = encoding.popleft()
+                try:
+                    message = encode_future.result()
+                except Exception as e:
+                    print(f"[WebSocketImageSender] 图像 {index+1} 编码错误: {e}")
+                    continue
+                
+                # 按batch_index顺序提交；同一连接上的消息按提交顺序写出
+                sending.append((index, self._submit_websocket(websocket_url, message, pool)))
+                if len(sending) >= PIPELINE_DEPTH:
+                    finish_send(*sending.popleft())
+            
+            while sending:
+                finish_send(*sending.popleft())
+            
             # 透传原始图像
             return (images,)
             
@@ -94,36 +242,13 @@ class WebSocketImageSender:
             # 即使出错也要透传图像
             return (images,)
     
-    async def _send_websocket_message(self, websocket_url, message):
-        """
-        使用 websockets 库发送消息的异步方法
-        """
-        try:
-            # 设置连接超时和ping参数
-            async with websockets.connect(
-                websocket_url,
-                open_timeout=10,  # 连接超时10秒
-                close_timeout=5,  # 关闭超时5秒
-                ping_interval=20, # ping间隔20秒
-                ping_timeout=10   # ping超时10秒
-            ) as websocket:
-                await websocket.send(message)
-                print(f"[WebSocketImageSender] 消息发送成功到 {websocket_url}")
-        except Exception as e:
-            raise e
+    def _submit_websocket(self, websocket_url, message, pool=None):
+        """提交消息到共享连接池，不等待发送完成，返回Future"""
+        return (pool or get_websocket_pool()).submit(websocket_url, message)
     
     def _send_websocket_sync(self, websocket_url, message):
-        """同步方式发送 WebSocket 消息"""
-        def run_async():
-            try:
-                asyncio.run(self._send_websocket_message(websocket_url, message))
-            except Exception as e:
-                print(f"[WebSocketImageSender] WebSocket发送错误: {e}")
-        
-        # 在新线程中运行异步代码
-        thread = threading.Thread(target=run_async)
-        thread.start()
-        thread.join()  # 等待线程完成
+        """通过共享连接池发送 WebSocket 消息，等待发送完成"""
+        get_websocket_pool().submit(websocket_url, message).result(timeout=SEND_TIMEOUT)
 
 # 节点映射
 NODE_CLASS_MAPPINGS = {
@@ -8,6 +8,11 @@ from server import PromptServer
 import websockets
 import asyncio
 
+try:
+    from .io_runtime import get_io_runtime
+except ImportError:
+    from io_runtime import get_io_runtime
+
 class WorkflowSaverNode:
     @classmethod
     def INPUT_TYPES(cls):
@@ -102,17 +107,10 @@ class WorkflowListNode:
 
     def get_workflow_list(self, refresh, trigger=None):
         try:
-            # 通过WebSocket获取工作流列表
-            import asyncio
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
+            # 通过WebSocket获取工作流列表（在共享I/O事件循环中运行，不再每次创建事件循环）
+            workflow_list = get_io_runtime().run(self.fetch_workflow_list())
+            return (json.dumps(workflow_list, ensure_ascii=False),)
             
-            try:
-                workflow_list = loop.run_until_complete(self.fetch_workflow_list())
-                return (json.dumps(workflow_list, ensure_ascii=False),)
-            finally:
-                loop.close()
-                
         except Exception as e:
             error_msg = f"获取工作流列表时出错: {str(e)}"
             print(error_msg)